@@ -0,0 +1,158 @@
+# vim:set et sw=4 encoding=utf-8:
+#
+# Catalog of the images installed in the target directory
+#
+# Licensed under the EUPL, Version 1.0 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# you may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+#
+# http://ec.europa.eu/idabc/eupl
+#
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+
+"""Catalog of the images installed in the target directory.
+
+It records the versions, sizes and checksums of the images and when they
+were synced and last used, in an SQLite database next to the images that
+is updated by vbox-sync, vbox-invoke and vbox-dispose.
+"""
+
+import os.path
+import time
+
+try:
+    import sqlite3
+except ImportError:
+    try:
+        from pysqlite2 import dbapi2 as sqlite3
+    except ImportError:
+        sqlite3 = None
+
+CATALOG_FILENAME = '.catalog.sqlite'
+
+# Seconds to wait for another process to finish writing.
+LOCK_TIMEOUT = 30
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS images (
+    name TEXT PRIMARY KEY,
+    version TEXT NOT NULL,
+    size INTEGER,
+    checksum TEXT,
+    synced REAL,
+    last_used REAL,
+    uses INTEGER NOT NULL DEFAULT 0
+)
+'''
+
+_columns = ('name', 'version', 'size', 'checksum', 'synced', 'last_used',
+            'uses')
+
+class CatalogError(Exception):
+    """This exception is raised when the catalog cannot be read or
+    written, e.g. because SQLite is not available or the catalog is
+    owned by root.  The catalog is advisory, callers should go on without
+    it."""
+    pass
+
+def catalog_path(target):
+    return os.path.join(target, CATALOG_FILENAME)
+
+class ImageCatalog(object):
+    """The catalog of the images in a target directory.  Every method uses
+    its own connection and transaction, so that concurrent vbox-sync and
+    vbox-invoke processes see each other's changes and never overwrite
+    them."""
+
+    def __init__(self, target):
+        self.path = catalog_path(target)
+
+    def _connect(self, write):
+        if sqlite3 is None:
+            raise CatalogError, 'SQLite not available'
+        if not write and not os.path.exists(self.path):
+            return None
+        try:
+            # Transactions are started explicitly below.
+            connection = sqlite3.connect(self.path, timeout=LOCK_TIMEOUT,
+                                         isolation_level=None)
+        except sqlite3.Error, e:
+            raise CatalogError, '%s: %s' % (self.path, e)
+        # Like everywhere else, names and versions are byte strings.
+        connection.text_factory = str
+        if write:
+            try:
+                # Take the write lock right away instead of failing on
+                # the first write if another process holds it.
+                connection.execute('BEGIN IMMEDIATE')
+                connection.execute(_schema)
+            except sqlite3.Error, e:
+                connection.close()
+                raise CatalogError, '%s: %s' % (self.path, e)
+        return connection
+
+    def _write(self, *statements):
+        """Runs the (statement, parameters) pairs in one transaction."""
+        connection = self._connect(True)
+        try:
+            try:
+                for statement, parameters in statements:
+                    connection.execute(statement, parameters)
+                connection.execute('COMMIT')
+            except sqlite3.Error, e:
+                connection.execute('ROLLBACK')
+                raise CatalogError, '%s: %s' % (self.path, e)
+        finally:
+            connection.close()
+
+    def record_sync(self, name, version, size, checksum=None):
+        """Records that version of the image was synced.  The usage
+        information is kept across versions."""
+        self._write(('INSERT OR IGNORE INTO images (name, version) '
+                     'VALUES (?, ?)', (name, version)),
+                    ('UPDATE images SET version = ?, size = ?, checksum = ?, '
+                     'synced = ? WHERE name = ?',
+                     (version, size, checksum, time.time(), name)))
+
+    def record_use(self, name, version):
+        """Records that the image was invoked.  Images installed before
+        the catalog existed are added here."""
+        self._write(('INSERT OR IGNORE INTO images (name, version) '
+                     'VALUES (?, ?)', (name, version)),
+                    ('UPDATE images SET last_used = ?, uses = uses + 1 '
+                     'WHERE name = ?', (time.time(), name)))
+
+    def remove(self, name):
+        self._write(('DELETE FROM images WHERE name = ?', (name,)))
+
+    def images(self):
+        """Returns a dict mapping image names to dicts with the columns of
+        the catalog."""
+        connection = self._connect(False)
+        if connection is None:
+            return {}
+        try:
+            try:
+                rows = connection.execute('SELECT %s FROM images' %
+                                          ', '.join(_columns)).fetchall()
+            except sqlite3.Error, e:
+                raise CatalogError, '%s: %s' % (self.path, e)
+        finally:
+            connection.close()
+        images = {}
+        for row in rows:
+            images[row[0]] = dict(zip(_columns, row))
+        return images
+
+    def get(self, name):
+        """Returns the entry of the image or None."""
+        return self.images().get(name)
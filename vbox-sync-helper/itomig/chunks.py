@@ -0,0 +1,322 @@
+# vim:set et sw=4 encoding=utf-8:
+#
+# Content-addressed chunk transport for image files
+#
+# Licensed under the EUPL, Version 1.0 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# you may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+#
+# http://ec.europa.eu/idabc/eupl
+#
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+
+"""Content-addressed chunk transport of vbox-sync.
+
+An image is described by a manifest listing the SHA-256 hashes of its
+fixed-size chunks.  Chunks are stored under their hash, so that identical
+regions of different images and versions are transferred and stored only
+once.
+"""
+
+import errno
+import fcntl
+import hashlib
+import os
+import os.path
+import shutil
+import struct
+import tempfile
+import threading
+
+# The block size of VDI images, so that identical guest blocks end up in
+# identical chunks as long as they are stored at the same position.
+CHUNK_SIZE = 1024 * 1024
+
+# Suffix of the manifest file published next to an image file.
+MANIFEST_SUFFIX = '.chunks'
+
+# ioctl request number for cloning a range of one file into another on
+# filesystems that support reflinks (linux/fs.h).
+FICLONERANGE = 0x4020940d
+
+def cpu_count():
+    try:
+        return max(1, os.sysconf('SC_NPROCESSORS_ONLN'))
+    except (AttributeError, ValueError, OSError):
+        return 1
+
+class ChunkManifestError(Exception):
+    """This exception is raised when a chunk manifest cannot be parsed."""
+    pass
+
+class ChunkManifest(object):
+    """Describes a file as the ordered list of the hashes of its chunks."""
+
+    def __init__(self, size, chunk_size, digests):
+        self.size = size
+        self.chunk_size = chunk_size
+        self.digests = digests
+        self._zero_digests = {}
+
+    def from_file(cls, filename, chunk_size=CHUNK_SIZE):
+        """Creates the manifest of the given file by hashing it."""
+        digests = []
+        f = open(filename, 'rb')
+        try:
+            while True:
+                data = f.read(chunk_size)
+                if not data:
+                    break
+                digests.append(hashlib.sha256(data).hexdigest())
+        finally:
+            f.close()
+        return cls(os.path.getsize(filename), chunk_size, digests)
+    from_file = classmethod(from_file)
+
+    def read(cls, filename):
+        """Reads a manifest as written by write()."""
+        size, chunk_size, digests = None, None, []
+        f = open(filename)
+        try:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                fields = line.split()
+                if fields[0] == 'size' and len(fields) == 2:
+                    size = int(fields[1])
+                elif fields[0] == 'chunksize' and len(fields) == 2:
+                    chunk_size = int(fields[1])
+                elif len(fields) == 1 and len(fields[0]) == 64:
+                    digests.append(fields[0])
+                else:
+                    raise ChunkManifestError, 'invalid line: %s' % line
+        finally:
+            f.close()
+        if size is None or not chunk_size:
+            raise ChunkManifestError, 'size or chunk size missing'
+        if len(digests) != (size + chunk_size - 1) // chunk_size:
+            raise ChunkManifestError, 'number of chunks does not match size'
+        return cls(size, chunk_size, digests)
+    read = classmethod(read)
+
+    def write(self, filename):
+        f = open(filename, 'w')
+        try:
+            f.write('# vbox-sync chunk manifest\n')
+            f.write('size %d\n' % self.size)
+            f.write('chunksize %d\n' % self.chunk_size)
+            for digest in self.digests:
+                f.write('%s\n' % digest)
+        finally:
+            f.close()
+
+    def chunks(self):
+        """Yields (offset, length, digest) for every chunk."""
+        for index, digest in enumerate(self.digests):
+            offset = index * self.chunk_size
+            yield offset, min(self.chunk_size, self.size - offset), digest
+
+    def digest(self):
+        """A hash identifying the manifest as a whole."""
+        return hashlib.sha256(''.join(self.digests)).hexdigest()
+
+    def matches(self, filename, jobs=None):
+        """Tells whether the given file is the one described by the
+        manifest.  The file is hashed in jobs threads (by default one per
+        CPU) that each read a contiguous range of chunks; hashlib releases
+        the interpreter lock while hashing."""
+        if not os.path.exists(filename) or \
+           os.path.getsize(filename) != self.size:
+            return False
+        if not self.digests:
+            return True
+        if jobs is None:
+            jobs = cpu_count()
+        jobs = max(1, min(jobs, len(self.digests)))
+        per_job = (len(self.digests) + jobs - 1) // jobs
+        mismatch = []
+
+        def check(first, last):
+            f = open(filename, 'rb')
+            try:
+                f.seek(first * self.chunk_size)
+                for index in xrange(first, last):
+                    if mismatch:
+                        # Another thread found a difference already.
+                        return
+                    data = f.read(self.chunk_size)
+                    if hashlib.sha256(data).hexdigest() != \
+                       self.digests[index]:
+                        mismatch.append(index)
+                        return
+            finally:
+                f.close()
+
+        threads = []
+        for first in xrange(0, len(self.digests), per_job):
+            thread = threading.Thread(target=check, args=(first,
+                min(first + per_job, len(self.digests))))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return not mismatch
+
+    def is_zero(self, length, digest):
+        """Tells whether the chunk consists of zeros only.  Those are
+        neither transferred nor written, but left as holes."""
+        if length not in self._zero_digests:
+            self._zero_digests[length] = \
+                hashlib.sha256('\0' * length).hexdigest()
+        return self._zero_digests[length] == digest
+
+def clone_range(src, src_offset, length, dst, dst_offset):
+    """Shares the given range of the file object src with dst through a
+    reflink if the filesystem supports it.  Returns False if it does not,
+    in which case the caller needs to copy the data."""
+    arg = struct.pack('qQQQ', src.fileno(), src_offset, length, dst_offset)
+    try:
+        fcntl.ioctl(dst.fileno(), FICLONERANGE, arg)
+    except IOError, e:
+        if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV,
+                       errno.EINVAL, errno.ENOSYS):
+            return False
+        raise
+    return True
+
+class ChunkStore(object):
+    """A directory holding chunks named by their hash, split into 256
+    subdirectories by the first two hex digits.  On the server it holds
+    the chunks of all published images, on the client it only holds the
+    chunks fetched for images that are not installed yet."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def relative_path(self, digest):
+        return os.path.join(digest[:2], digest)
+
+    def chunk_path(self, digest):
+        return os.path.join(self.path, self.relative_path(digest))
+
+    def __contains__(self, digest):
+        return os.path.exists(self.chunk_path(digest))
+
+    def verify(self, digest):
+        """Hashes the stored chunk and removes it if it does not match
+        its name.  Returns whether it matched."""
+        f = open(self.chunk_path(digest), 'rb')
+        try:
+            matches = hashlib.sha256(f.read()).hexdigest() == digest
+        finally:
+            f.close()
+        if not matches:
+            os.unlink(self.chunk_path(digest))
+        return matches
+
+    def add_from_file(self, filename, manifest):
+        """Stores all chunks of the file described by the manifest that
+        are not in the store yet, except for zero chunks.  Returns the
+        number of chunks added."""
+        added = 0
+        f = open(filename, 'rb')
+        try:
+            for offset, length, digest in manifest.chunks():
+                if digest in self or manifest.is_zero(length, digest):
+                    continue
+                f.seek(offset)
+                data = f.read(length)
+                chunk_dir = os.path.dirname(self.chunk_path(digest))
+                if not os.path.exists(chunk_dir):
+                    os.makedirs(chunk_dir, 0755)
+                # Write to a temporary file first, so that readers never
+                # see a partial chunk under its final name.
+                (handle, tmp) = tempfile.mkstemp('', '.chunk-', chunk_dir)
+                try:
+                    os.write(handle, data)
+                finally:
+                    os.close(handle)
+                os.chmod(tmp, 0644)
+                os.rename(tmp, self.chunk_path(digest))
+                added += 1
+        finally:
+            f.close()
+        return added
+
+    def clear(self):
+        """Removes all chunks from the store."""
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+
+class ChunkAssembler(object):
+    """Reassembles files from chunks.  Chunks are taken from the store or
+    from already installed files, as described by their manifests."""
+
+    def __init__(self, store, sources):
+        self.store = store
+        # Maps the chunk hashes of the installed files to their location.
+        self._index = {}
+        for filename, manifest in sources:
+            for offset, length, digest in manifest.chunks():
+                self._index.setdefault(digest, (filename, offset))
+        self._reflink = True
+
+    def _locate(self, digest):
+        if digest in self.store:
+            return self.store.chunk_path(digest), 0
+        return self._index.get(digest)
+
+    def missing(self, manifest):
+        """Returns the hashes of all chunks that need to be fetched."""
+        missing = set()
+        for offset, length, digest in manifest.chunks():
+            if not manifest.is_zero(length, digest) and \
+               self._locate(digest) is None:
+                missing.add(digest)
+        return missing
+
+    def _copy_chunk(self, src, src_offset, length, dst, dst_offset):
+        if self._reflink:
+            if clone_range(src, src_offset, length, dst, dst_offset):
+                return
+            # Reflinks are generally not available for this pair of files,
+            # do not waste further system calls on them.
+            self._reflink = False
+        src.seek(src_offset)
+        dst.seek(dst_offset)
+        dst.write(src.read(length))
+
+    def assemble(self, manifest, target):
+        """Writes the file described by the manifest to target.  Zero
+        chunks are left as holes."""
+        # target might be a hardlink to some other file, never write
+        # through it.
+        if os.path.exists(target):
+            os.unlink(target)
+        dst = open(target, 'wb')
+        try:
+            dst.truncate(manifest.size)
+            for offset, length, digest in manifest.chunks():
+                if manifest.is_zero(length, digest):
+                    continue
+                location = self._locate(digest)
+                if location is None:
+                    raise ChunkManifestError, 'chunk %s not available' % \
+                                              digest
+                src = open(location[0], 'rb')
+                try:
+                    self._copy_chunk(src, location[1], length, dst, offset)
+                finally:
+                    src.close()
+        finally:
+            dst.close()
@@ -0,0 +1,335 @@
+# vim:set et sw=4 encoding=utf-8:
+#
+# Creation of empty data disk images
+#
+# Licensed under the EUPL, Version 1.0 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# you may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+#
+# http://ec.europa.eu/idabc/eupl
+#
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+
+"""Creation of empty data disks without external tools.
+
+A data disk is a dynamic VDI image holding an MBR with a single FAT16 or
+FAT32 partition.  Only the blocks that contain metadata are allocated, so
+creating even a large disk writes a few megabytes at most and needs no
+root privileges.
+"""
+
+import errno
+import os
+import os.path
+import struct
+import tempfile
+
+from itomig.filecopy import copy_sparse
+
+SECTOR_SIZE = 512
+
+# Legacy disk geometry used for the CHS values of the MBR and the VDI
+# header.  The partition types used address the disk through LBA anyway.
+HEADS = 16
+SECTORS_PER_TRACK = 63
+
+# The partition starts on the second track, like DOS partitioning tools
+# did it.
+PARTITION_START = SECTORS_PER_TRACK
+
+PARTITION_TYPES = {
+    'fat16': 0x0e,  # FAT16, LBA
+    'fat32': 0x0c,  # FAT32, LBA
+    }
+
+# Sectors per cluster by the maximum partition size in sectors, as
+# recommended by Microsoft's FAT specification.
+_FAT16_CLUSTER_SIZES = [
+    (32680, 2),
+    (262144, 4),
+    (524288, 8),
+    (1048576, 16),
+    (2097152, 32),
+    (4194304, 64),
+    ]
+_FAT32_CLUSTER_SIZES = [
+    (532480, 1),
+    (16777216, 8),
+    (33554432, 16),
+    (67108864, 32),
+    (0xffffffff, 64),
+    ]
+
+VDI_PRE_HEADER = '<<< innotek VirtualBox Disk Image >>>\n'
+VDI_SIGNATURE = 0xbeda107f
+VDI_VERSION = 0x00010001
+VDI_TYPE_NORMAL = 1
+VDI_HEADER_SIZE = 400
+VDI_BLOCK_SIZE = 1024 * 1024
+VDI_BLOCK_FREE = 0xffffffff
+# Offset of the creation UUID, which VirtualBox identifies the image by.
+VDI_UUID_OFFSET = 392
+
+# File name of a data disk template by size in megabytes and filesystem.
+TEMPLATE_NAME = 'data-%dM-%s.vdi'
+
+class DataDiskError(Exception):
+    """This exception is raised when no data disk of the requested size
+    and filesystem can be created."""
+    pass
+
+class SparseDisk(object):
+    """The contents of a disk as the few regions that are not zero."""
+
+    def __init__(self, size):
+        self.size = size
+        self.regions = {}
+
+    def write(self, offset, data):
+        assert offset + len(data) <= self.size
+        self.regions[offset] = data
+
+    def write_sector(self, sector, data):
+        self.write(sector * SECTOR_SIZE, data)
+
+    def blocks(self, block_size):
+        """Returns a dict mapping the numbers of all blocks containing
+        data to their contents."""
+        # Split the regions at block boundaries first.
+        pieces = {}
+        for offset, data in self.regions.items():
+            while data:
+                index, start = divmod(offset, block_size)
+                length = min(len(data), block_size - start)
+                pieces.setdefault(index, []).append((start, data[:length]))
+                offset += length
+                data = data[length:]
+        blocks = {}
+        for index, block_pieces in pieces.items():
+            block_pieces.sort()
+            block, position = [], 0
+            for start, data in block_pieces:
+                assert start >= position, 'overlapping regions'
+                block.append('\0' * (start - position))
+                block.append(data)
+                position = start + len(data)
+            block.append('\0' * (block_size - position))
+            blocks[index] = ''.join(block)
+        return blocks
+
+def _chs(sector):
+    """Returns the packed CHS address of the sector for the MBR."""
+    cylinder, rest = divmod(sector, HEADS * SECTORS_PER_TRACK)
+    if cylinder > 1023:
+        # Not addressable through CHS, use the maximum value.
+        return '\xfe\xff\xff'
+    head, sector = divmod(rest, SECTORS_PER_TRACK)
+    return struct.pack('<BBB', head, ((cylinder >> 2) & 0xc0) | (sector + 1),
+                       cylinder & 0xff)
+
+def _random_id():
+    return struct.unpack('<I', os.urandom(4))[0]
+
+def _mbr(fs_type, start, sectors):
+    entry = struct.pack('<B3sB3sII', 0, _chs(start), PARTITION_TYPES[fs_type],
+                        _chs(start + sectors - 1), start, sectors)
+    return struct.pack('<440sI2x', '', _random_id()) + entry + \
+           '\0' * 48 + '\x55\xaa'
+
+def _cluster_size(table, sectors):
+    for max_sectors, sectors_per_cluster in table:
+        if sectors <= max_sectors:
+            return sectors_per_cluster
+    raise DataDiskError, 'partition too large'
+
+def _fat_size(sectors, reserved, root_sectors, sectors_per_cluster, fat32):
+    """Computes the sectors per FAT as in Microsoft's FAT specification."""
+    tmp1 = sectors - (reserved + root_sectors)
+    tmp2 = 256 * sectors_per_cluster + 2
+    if fat32:
+        tmp2 = tmp2 // 2
+    return (tmp1 + tmp2 - 1) // tmp2
+
+def _format_fat(disk, fs_type, start, sectors):
+    """Writes an empty FAT filesystem to the partition."""
+    fat32 = fs_type == 'fat32'
+    if fat32:
+        reserved, root_entries = 32, 0
+        sectors_per_cluster = _cluster_size(_FAT32_CLUSTER_SIZES, sectors)
+    else:
+        reserved, root_entries = 1, 512
+        sectors_per_cluster = _cluster_size(_FAT16_CLUSTER_SIZES, sectors)
+    root_sectors = root_entries * 32 // SECTOR_SIZE
+    fat_size = _fat_size(sectors, reserved, root_sectors, sectors_per_cluster,
+                         fat32)
+    data_start = reserved + 2 * fat_size + root_sectors
+    clusters = (sectors - data_start) // sectors_per_cluster
+    if (fat32 and clusters < 65525) or \
+       (not fat32 and not 4085 <= clusters < 65525):
+        raise DataDiskError, '%s partition with %d sectors not possible' % \
+                             (fs_type, sectors)
+    # The total number of sectors goes into the 16 bit field if it fits
+    # (FAT16 only), into the 32 bit field otherwise.
+    jump, small_sectors, small_fat_size = '\xeb\x3c\x90', 0, fat_size
+    if fat32:
+        jump, small_fat_size = '\xeb\x58\x90', 0
+    elif sectors < 0x10000:
+        small_sectors = sectors
+    bpb = struct.pack('<3s8sHBHBHHBHHHII', jump, 'MSWIN4.1', SECTOR_SIZE,
+                      sectors_per_cluster, reserved, 2, root_entries,
+                      small_sectors, 0xf8, small_fat_size, SECTORS_PER_TRACK,
+                      HEADS, start, sectors - small_sectors)
+    if fat32:
+        # Root directory in cluster 2, FS information in sector 1 and the
+        # backup boot sector in sector 6.
+        bpb += struct.pack('<IHHIHH12x', fat_size, 0, 0, 2, 1, 6)
+        label_fs_type = 'FAT32   '
+        fat = struct.pack('<III', 0x0ffffff8, 0x0fffffff, 0x0fffffff)
+    else:
+        label_fs_type = 'FAT16   '
+        fat = struct.pack('<HH', 0xfff8, 0xffff)
+    boot = bpb + struct.pack('<BBBI11s8s', 0x80, 0, 0x29, _random_id(),
+                             'NO NAME    ', label_fs_type)
+    boot = boot + '\0' * (SECTOR_SIZE - 2 - len(boot)) + '\x55\xaa'
+    disk.write_sector(start, boot)
+    if fat32:
+        free = clusters - 1
+        fsinfo = struct.pack('<I480xIII12xI', 0x41615252, 0x61417272, free,
+                             3, 0xaa550000)
+        disk.write_sector(start + 1, fsinfo)
+        # Backup copies of the boot sector and the FS information.
+        disk.write_sector(start + 6, boot)
+        disk.write_sector(start + 7, fsinfo)
+    for copy in range(2):
+        disk.write_sector(start + reserved + copy * fat_size, fat)
+
+def _random_uuid():
+    """Returns a random (version 4) UUID as 16 bytes."""
+    uuid = os.urandom(16)
+    return uuid[:7] + chr((ord(uuid[7]) & 0x0f) | 0x40) + \
+           chr((ord(uuid[8]) & 0x3f) | 0x80) + uuid[9:]
+
+def assign_new_uuid(filename):
+    """Gives the VDI image a new random UUID, so that copies of one image
+    can be registered with VirtualBox side by side."""
+    f = open(filename, 'r+b')
+    try:
+        f.seek(VDI_UUID_OFFSET)
+        f.write(_random_uuid())
+    finally:
+        f.close()
+
+def _write_vdi(disk, filename):
+    """Writes the disk as a dynamic VDI image that only contains the
+    blocks with data."""
+    blocks = disk.blocks(VDI_BLOCK_SIZE)
+    block_count = (disk.size + VDI_BLOCK_SIZE - 1) // VDI_BLOCK_SIZE
+    blocks_offset = 512
+    data_offset = blocks_offset + block_count * 4
+    data_offset = (data_offset + SECTOR_SIZE - 1) // SECTOR_SIZE * SECTOR_SIZE
+    block_map = [VDI_BLOCK_FREE] * block_count
+    indices = blocks.keys()
+    indices.sort()
+    for position, index in enumerate(indices):
+        block_map[index] = position
+    cylinders = min(disk.size // (HEADS * SECTORS_PER_TRACK * SECTOR_SIZE),
+                    16383)
+    geometry = struct.pack('<IIII', cylinders, HEADS, SECTORS_PER_TRACK,
+                           SECTOR_SIZE)
+    header = struct.pack('<64sII', VDI_PRE_HEADER, VDI_SIGNATURE,
+                         VDI_VERSION)
+    header += struct.pack('<III256sII', VDI_HEADER_SIZE, VDI_TYPE_NORMAL, 0,
+                          '', blocks_offset, data_offset)
+    header += geometry
+    header += struct.pack('<IQIIII', 0, disk.size, VDI_BLOCK_SIZE, 0,
+                          block_count, len(indices))
+    # Creation UUID (a random one, marked as version 4) and the empty
+    # modification, linkage and parent UUIDs.
+    header += _random_uuid() + '\0' * 48
+    header += geometry
+    f = open(filename, 'wb')
+    try:
+        f.write(header)
+        f.seek(blocks_offset)
+        f.write(struct.pack('<%dI' % block_count, *block_map))
+        for position, index in enumerate(indices):
+            f.seek(data_offset + position * VDI_BLOCK_SIZE)
+            f.write(blocks[index])
+    finally:
+        f.close()
+
+def default_fs_type(size):
+    """FAT32 is not worth it for small partitions and not even possible
+    for tiny ones."""
+    if size >= 128:
+        return 'fat32'
+    return 'fat16'
+
+def create_data_disk(filename, size, fs_type=None):
+    """Writes a data disk of size megabytes as a dynamic VDI image to
+    filename.  It contains one primary partition spanning the whole disk
+    formatted with fs_type (fat16 or fat32, by default depending on the
+    size)."""
+    if fs_type is None:
+        fs_type = default_fs_type(size)
+    if fs_type not in PARTITION_TYPES:
+        raise DataDiskError, 'unsupported filesystem %s' % fs_type
+    disk = SparseDisk(size * 1024 * 1024)
+    sectors = disk.size // SECTOR_SIZE - PARTITION_START
+    disk.write_sector(0, _mbr(fs_type, PARTITION_START, sectors))
+    _format_fat(disk, fs_type, PARTITION_START, sectors)
+    _write_vdi(disk, filename)
+
+class DataDiskTemplates(object):
+    """A directory of pristine data disks by size and filesystem, shared
+    by all users.  Copying a template is cheaper than creating the disk
+    and with reflinks or holes it does not take up any space either."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def template_path(self, size, fs_type=None):
+        if fs_type is None:
+            fs_type = default_fs_type(size)
+        return os.path.join(self.path, TEMPLATE_NAME % (size, fs_type))
+
+    def ensure(self, size, fs_type=None):
+        """Creates the template for the size and filesystem unless it
+        exists already and returns its path."""
+        template = self.template_path(size, fs_type)
+        if os.path.exists(template):
+            return template
+        if not os.path.exists(self.path):
+            os.makedirs(self.path, 0755)
+        # Readers must never see a partially written template.
+        (handle, tmp) = tempfile.mkstemp('.vdi', '.template-', self.path)
+        os.close(handle)
+        try:
+            create_data_disk(tmp, size, fs_type)
+            os.chmod(tmp, 0644)
+            os.rename(tmp, template)
+        except:
+            os.unlink(tmp)
+            raise
+        return template
+
+    def copy_to(self, filename, size, fs_type=None):
+        """Copies the template to filename and gives the copy a UUID of its
+        own.  Returns False if there is no such template."""
+        try:
+            copy_sparse(self.template_path(size, fs_type), filename)
+        except (IOError, OSError), e:
+            if e.errno in (errno.ENOENT, errno.EACCES):
+                return False
+            raise
+        assign_new_uuid(filename)
+        return True
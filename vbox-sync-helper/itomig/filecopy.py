@@ -0,0 +1,237 @@
+# vim:set et sw=4 encoding=utf-8:
+#
+# Sparse copies of image files
+#
+# Licensed under the EUPL, Version 1.0 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# you may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+#
+# http://ec.europa.eu/idabc/eupl
+#
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+
+"""Copies of image files that keep them sparse.
+
+Holes in the source stay holes in the copy and runs of zeros are not
+written out.
+
+The cheapest available method is used: a reflink shares all blocks with
+the source (FICLONE), copy_file_range and sendfile copy within the kernel
+and a copy through a large buffer is the last resort.
+"""
+
+import errno
+import fcntl
+import os
+
+try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+except (ImportError, OSError, TypeError):
+    _libc = None
+
+# lseek whence values to find data and holes in sparse files (Linux 3.1+).
+SEEK_DATA = 3
+SEEK_HOLE = 4
+
+# ioctl request number to clone a whole file on filesystems that support
+# reflinks (linux/fs.h).
+FICLONE = 0x40049409
+
+BUFFER_SIZE = 4 * 1024 * 1024
+# Granularity in which runs of zeros are turned into holes.
+ZERO_BLOCK_SIZE = 64 * 1024
+_ZEROS = '\0' * ZERO_BLOCK_SIZE
+
+# Errors meaning that a method is not available for the pair of files.
+_UNSUPPORTED = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL,
+                errno.ENOSYS, errno.EBADF)
+
+def disk_usage(filename):
+    """Returns the logical size of the file and the number of bytes
+    actually allocated for it on disk."""
+    st = os.stat(filename)
+    return st.st_size, st.st_blocks * 512
+
+def _data_extents(fd, size):
+    """Returns the (offset, length) pairs of the regions of the file
+    that contain data.  Raises OSError with EINVAL if the filesystem or
+    kernel does not support SEEK_DATA."""
+    extents = []
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, SEEK_DATA)
+        except OSError, e:
+            if e.errno == errno.ENXIO:
+                # Nothing but a hole up to the end of the file.
+                break
+            raise
+        end = os.lseek(fd, start, SEEK_HOLE)
+        extents.append((start, end - start))
+        offset = end
+    return extents
+
+def _clone(src_fd, dst_fd):
+    """Shares all blocks of the source with the destination.  Returns
+    False if the filesystem does not support it."""
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+    except IOError, e:
+        if e.errno in _UNSUPPORTED:
+            return False
+        raise
+    return True
+
+def _libc_call(name, *args):
+    """Calls the libc function and returns its result or raises OSError."""
+    result = getattr(_libc, name)(*args)
+    if result < 0:
+        error = ctypes.get_errno()
+        raise OSError, (error, os.strerror(error))
+    return result
+
+def _copy_file_range(src_fd, dst_fd, offset, length):
+    src_offset = ctypes.c_longlong(offset)
+    dst_offset = ctypes.c_longlong(offset)
+    return _libc_call('copy_file_range', src_fd, ctypes.byref(src_offset),
+                      dst_fd, ctypes.byref(dst_offset),
+                      ctypes.c_size_t(length), 0)
+
+def _sendfile_function():
+    """Returns the name of the sendfile variant taking a 64 bit offset or
+    None.  Plain sendfile takes an off_t, which is only 64 bits wide on
+    64 bit systems."""
+    if hasattr(_libc, 'sendfile64'):
+        return 'sendfile64'
+    if hasattr(_libc, 'sendfile') and \
+       ctypes.sizeof(ctypes.c_long) == ctypes.sizeof(ctypes.c_longlong):
+        return 'sendfile'
+    return None
+
+def _sendfile(src_fd, dst_fd, offset, length):
+    os.lseek(dst_fd, offset, os.SEEK_SET)
+    src_offset = ctypes.c_longlong(offset)
+    return _libc_call(_sendfile_function(), dst_fd, src_fd,
+                      ctypes.byref(src_offset), ctypes.c_size_t(length))
+
+class _Copier(object):
+    """Copies regions of one file to another with the in-kernel methods
+    as long as they work and through a buffer otherwise."""
+
+    def __init__(self, src_fd, dst_fd, progress, size):
+        self.src_fd = src_fd
+        self.dst_fd = dst_fd
+        self.progress = progress
+        self.size = size
+        self.done = 0
+        self.methods = []
+        if _libc is not None:
+            # copy_file_range always takes 64 bit offsets.
+            if hasattr(_libc, 'copy_file_range'):
+                self.methods.append(_copy_file_range)
+            if _sendfile_function():
+                self.methods.append(_sendfile)
+
+    def _report(self, length):
+        self.done += length
+        if self.progress:
+            self.progress(self.done, self.size)
+
+    def _copy_in_kernel(self, offset, end):
+        """Copies as much as possible of the region within the kernel and
+        returns the offset up to which it was copied."""
+        while self.methods and offset < end:
+            try:
+                copied = self.methods[0](self.src_fd, self.dst_fd, offset,
+                                         min(BUFFER_SIZE, end - offset))
+            except OSError, e:
+                if e.errno not in _UNSUPPORTED:
+                    raise
+                # Not available for these files, do not try again.
+                del self.methods[0]
+                continue
+            if not copied:
+                break
+            offset += copied
+            self._report(copied)
+        return offset
+
+    def copy_extent(self, offset, length, skip_zeros):
+        """Copies the given region.  If skip_zeros is true, blocks that
+        consist of zeros only are not written and become holes in the
+        destination.  This needs the data to pass through a buffer."""
+        end = offset + length
+        if not skip_zeros:
+            offset = self._copy_in_kernel(offset, end)
+        while offset < end:
+            os.lseek(self.src_fd, offset, os.SEEK_SET)
+            data = os.read(self.src_fd, min(BUFFER_SIZE, end - offset))
+            if not data:
+                break
+            self._write_non_zero(offset, data)
+            offset += len(data)
+            self._report(len(data))
+
+    def _write_non_zero(self, offset, data):
+        """Writes the data at offset, leaving out blocks of zeros.  The
+        blocks in between are written together."""
+        start = None
+        # The end of the data terminates the last run.
+        for position in range(0, len(data), ZERO_BLOCK_SIZE) + [len(data)]:
+            block = data[position:position + ZERO_BLOCK_SIZE]
+            if block and block != _ZEROS[:len(block)]:
+                if start is None:
+                    start = position
+                continue
+            if start is not None:
+                os.lseek(self.dst_fd, offset + start, os.SEEK_SET)
+                chunk = data[start:position]
+                written = 0
+                while written < len(chunk):
+                    written += os.write(self.dst_fd, chunk[written:])
+                start = None
+
+def copy_sparse(src, dst, progress=None):
+    """Copies the contents of the file src to dst, preserving holes.  If
+    given, progress is called with the number of bytes copied so far and
+    the total number of bytes while copying."""
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+        try:
+            size = os.fstat(src_fd).st_size
+            if _clone(src_fd, dst_fd):
+                if progress:
+                    progress(size, size)
+                return
+            try:
+                extents = _data_extents(src_fd, size)
+                # The holes are known, the data can be copied as it is.
+                skip_zeros = False
+            except OSError, e:
+                if e.errno != errno.EINVAL:
+                    raise
+                # Holes can only be found by looking at the data.
+                extents = [(0, size)]
+                skip_zeros = True
+            copier = _Copier(src_fd, dst_fd, progress,
+                             sum([length for offset, length in extents]))
+            for offset, length in extents:
+                copier.copy_extent(offset, length, skip_zeros)
+            # Trailing holes are not covered by any write.
+            os.ftruncate(dst_fd, size)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
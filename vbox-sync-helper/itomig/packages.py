@@ -0,0 +1,114 @@
+# vim:set et sw=4 encoding=utf-8:
+#
+# Lookup of the Debian packages images were installed from
+#
+# Licensed under the EUPL, Version 1.0 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# you may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+#
+# http://ec.europa.eu/idabc/eupl
+#
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+
+"""Lookup of the Debian packages images were shipped in.
+
+The versions of all installed packages are read with a single
+dpkg-query run and kept until the dpkg status file changes.
+"""
+
+import os
+import subprocess
+import threading
+
+DPKG_STATUS = '/var/lib/dpkg/status'
+
+# Package states in which the files of a package are on the disk.
+_unpacked_states = ('installed', 'unpacked', 'half-configured',
+                    'triggers-awaited', 'triggers-pending')
+
+def image_package_candidates(image_name):
+    """The names an image package might have, in order of preference."""
+    return ['%s-vbox' % image_name, 'vbox-%s' % image_name, image_name]
+
+class InstalledPackages(object):
+    """Maps the names of the installed packages to their versions."""
+
+    def __init__(self, status_file=DPKG_STATUS):
+        self.status_file = status_file
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._versions = None
+
+    def _status_mtime(self):
+        try:
+            return os.stat(self.status_file).st_mtime
+        except OSError:
+            return None
+
+    def _query(self):
+        versions = {}
+        try:
+            p = subprocess.Popen(['dpkg-query', '--show', '--showformat',
+                                  '${Package}\\t${Version}\\t${Status}\\n'],
+                                 stdout=subprocess.PIPE)
+        except OSError:
+            # Not a Debian system.
+            return versions
+        for line in p.communicate()[0].splitlines():
+            fields = line.split('\t')
+            if len(fields) != 3 or not fields[2].split() or \
+               fields[2].split()[-1] not in _unpacked_states:
+                continue
+            versions[fields[0]] = fields[1]
+        return versions
+
+    def versions(self):
+        """Returns a dict mapping package names to versions."""
+        self._lock.acquire()
+        try:
+            mtime = self._status_mtime()
+            if self._versions is None or mtime != self._mtime:
+                self._versions = self._query()
+                self._mtime = mtime
+            return self._versions
+        finally:
+            self._lock.release()
+
+    def invalidate(self):
+        self._lock.acquire()
+        try:
+            self._versions = None
+        finally:
+            self._lock.release()
+
+    def version_of(self, package_name):
+        """Returns the version of the package or None if it is not
+        installed."""
+        return self.versions().get(package_name)
+
+    def find_image_package(self, image_name):
+        """Returns the name of the installed package that shipped the
+        image or None."""
+        versions = self.versions()
+        for package_name in image_package_candidates(image_name):
+            if package_name in versions:
+                return package_name
+        return None
+
+_installed_packages = None
+
+def InstalledPackageIndex():
+    """Returns the index of installed packages shared within the process."""
+    global _installed_packages
+    if _installed_packages is None:
+        _installed_packages = InstalledPackages()
+    return _installed_packages
@@ -31,16 +31,41 @@ __VERSION__ = "@VERSION@"
 
 from ConfigParser import ConfigParser
 import errno
+import fcntl
 import logging
 import optparse
 import os
 import os.path
+import Queue
+import random
 import subprocess
 import shutil
 import sys
 import tempfile
+import threading
+import time
 import re
 
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+try:
+    from debian.debian_support import Version as DebianVersion
+except ImportError:
+    from debian_bundle.debian_support import Version as DebianVersion
+
+from itomig.catalog import CatalogError, ImageCatalog
+from itomig.chunks import ChunkAssembler, ChunkManifest, \
+    ChunkManifestError, ChunkStore, MANIFEST_SUFFIX
+from itomig.datadisk import create_data_disk, DataDiskTemplates
+from itomig.filecopy import copy_sparse, disk_usage
+from itomig.packages import InstalledPackageIndex
+from itomig.vboxbackend import create_backend, guarded_vboxmanage_call, \
+    VBoxInvocationError
+from itomig.vboxsettings import VBoxSettingsReader, VBoxSettingsError
+
 class ImageNotFoundError(Exception):
     """This exception is raised when the specified image cannot be found
     with the given version on the rsync server (vbox-sync) or if the image
@@ -54,6 +79,12 @@ class PackageNotFoundError(Exception):
     """
     pass
 
+class ImageEvictedError(ImageNotFoundError):
+    """This exception is raised by vbox-invoke when the image was evicted
+    from the target directory to save space and cannot be synced again
+    by the invoking user."""
+    pass
+
 class RsyncError(Exception):
     """This exception is raised when the rsync invocation to fetch the
     image or to list the directory on the server fails with a different
@@ -61,6 +92,12 @@ class RsyncError(Exception):
     """
     pass
 
+class ImageVerificationError(Exception):
+    """This exception is raised when a freshly transferred file does not
+    look like what it is supposed to be.  The file is left in the staging
+    directory and not put into place."""
+    pass
+
 class TargetNotWriteableError(Exception):
     """This exception is raised when the target direction of the sync
     operation is not writeable, which is commonly the case if the target
@@ -68,31 +105,93 @@ class TargetNotWriteableError(Exception):
     normal, unprivileged user."""
     pass
 
+# The signature of VirtualBox disk images, following the 64 byte text
+# header ("<<< Sun xVM VirtualBox Disk Image >>>" or similar).
+VDI_SIGNATURE_OFFSET = 64
+VDI_SIGNATURE = '\x7f\x10\xda\xbe'
+
+# Connection and I/O timeout in seconds for rsync transfers from peers.
+PEER_TIMEOUT = 10
+
+SYSTEM_CONFIG = '/etc/vbox-sync.cfg'
+
+# How unprivileged users restore evicted images, see debian/sudoers.
+RESTORE_COMMAND = ['sudo', '-n', '/usr/sbin/vbox-sync', '--restore']
+
+# Multipliers of the suffixes of sizes in the configuration.
+_size_units = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3,
+               'T': 1024 ** 4}
+
+# Minimum interval in seconds between two progress events for a file.
+PROGRESS_INTERVAL = 1.0
+
+# A progress line as printed by rsync --progress, e.g.
+# "  1,234,567  45%   10.50MB/s    0:01:23".
+_rsync_progress_re = re.compile(r'^\s*([\d,.]+)\s+(\d+)%\s+([\d,.]+)([kMG]?)B/s'
+                                r'\s+(\d+):(\d+):(\d+)')
+_rate_units = {'': 1, 'k': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+# A file as listed by rsync --list-only, e.g.
+# "-rw-r--r--    1,234,567 2009/05/01 12:00:00 image/1/image.vdi".
+_rsync_list_re = re.compile(r'^-\S{9}\s+([\d,.]+)\s+\S+\s+\S+\s+(.+)$')
+
 class VBoxImageSync(object):
-    def __init__(self, image):
+    def __init__(self, image, bwlimit=None, progress=True, basis=None,
+                 listener=None):
         self.image = image
         self.config = image.config
         self.image_name = image.image_name
         self.image_version = image.image_version
         self.logger = image.logger
-
-    def _check_presence(self):
-        self._check_rsync_file(self._construct_url(self.image.vdi_filename()))
-        self._check_rsync_file(self._construct_url(self.image.cfg_filename()))
-
-    def _check_rsync_file(self, filename):
-        """Submits a list request to the rsync server and raises
-        ImageNotFoundError if rsync returns with a failure of 23
-        (which is caused by ENOENT, among others) or raises
-        RsyncError if rsync returns with any other error."""
-        retcode = subprocess.call(['rsync', '-q', filename])
-        if retcode == 0:
-            self.logger.debug('Image found on the server.')
+        # Bandwidth limit in KB/s handed to rsync, None means unlimited.
+        self.bwlimit = bwlimit
+        # Whether rsync may draw its progress meter on the terminal.  This
+        # is turned off for concurrent syncs, as their output would mix.
+        self.progress = progress
+        # A local VDI to use as delta basis if the image is not installed
+        # yet, e.g. the previous version of a renamed image.
+        self.basis = basis
+        # Called with a dict for every progress event, see _emit().
+        self.listener = listener
+        # Transfer statistics reported by rsync, filled in by sync().
+        self.stats = {}
+        self._manifest = None
+        self._manifest_fetched = False
+        self._vdi_verified = False
+        # The files of the image on the server according to the remote
+        # catalog, None if it is not known.
+        self._remote_files = None
+
+    def _check_remote_files(self):
+        """Looks the image up in the remote catalog instead of asking the
+        server about every file.  If a file of the image is missing from a
+        cached listing, it may have been published since, so the listing
+        is fetched again before giving up.  If the server cannot be
+        listed, the transfer itself serves as the presence check."""
+        catalog = RemoteCatalog(self.config)
+        required = [self.image.cfg_filename(), self.image.vdi_filename()]
+        try:
+            files = catalog.image_files(self.image_name, self.image_version)
+            missing = [filename for filename in required
+                       if filename not in files]
+            if missing and not catalog.fetched_here:
+                # The cached listing may also have caught a version in the
+                # middle of its upload.
+                catalog.refresh()
+                files = catalog.image_files(self.image_name,
+                                            self.image_version)
+                missing = [filename for filename in required
+                           if filename not in files]
+        except RsyncError, e:
+            self.logger.debug('Cannot list the server: rsync returned %s', e)
             return
-        elif retcode == 23:
-            raise ImageNotFoundError
-        else:
-            raise RsyncError, retcode
+        if missing:
+            raise ImageNotFoundError, ', '.join(missing)
+        self._remote_files = files
+
+    def _remote_has(self, filename):
+        """Tells whether the file may be on the server."""
+        return self._remote_files is None or filename in self._remote_files
 
     def _check_target_writeable(self):
         if not os.path.exists(self.image.vdi_path()):
@@ -104,6 +203,20 @@ class VBoxImageSync(object):
         basedir = os.path.dirname(self.image.vdi_path())
         if not os.path.exists(basedir):
             os.makedirs(basedir, 0755)
+        if not os.path.exists(self.image.partial_path()):
+            os.makedirs(self.image.partial_path(), 0755)
+
+    def _remove_stale_partials(self):
+        """Removes staged files that were last written to more than
+        config.partial_max_age days ago, instead of resuming them.  The
+        change time is used, as rsync sets the mtime of transferred files
+        to the one on the server, which may be much older."""
+        max_age = self.config.partial_max_age * 24 * 60 * 60
+        for filename in os.listdir(self.image.partial_path()):
+            path = os.path.join(self.image.partial_path(), filename)
+            if time.time() - os.stat(path).st_ctime > max_age:
+                self.logger.info('Removing stale partial file %s', path)
+                os.unlink(path)
 
     def _construct_url(self, filename):
         """Constructs a URL to the image file we want to retrieve based
@@ -115,55 +228,977 @@ class VBoxImageSync(object):
         url = '/'.join([self.config.baseurl, image_path])
         return url
 
-    def _sync_file(self, source, target):
-        retcode = subprocess.call(['rsync', '--progress', '--times',
-                                   source, target])
-        if retcode != 0:
-            raise RsyncError, retcode
-        # Make it publically readable, do not inherit the permission
-        # even if copied from the local disk.
-        os.chmod(target, 0644)
+    def _parse_missing_files(self, rsync_stderr):
+        """Returns the basenames of all files rsync reported as missing
+        on the server."""
+        missing = []
+        for m in re.finditer(r'link_stat "([^"]*)".*failed: '
+                             r'No such file or directory', rsync_stderr):
+            missing.append(os.path.basename(m.group(1)))
+        return missing
+
+    def _parse_stats(self, rsync_output):
+        """Extracts the number of bytes sent over the wire (literal data)
+        and reused from the local basis (matched data) from the output
+        of rsync --stats."""
+        stats = {}
+        for key in ['literal', 'matched']:
+            m = re.search(r'^%s data: ([\d,.]+) bytes' % key.capitalize(),
+                          rsync_output, re.MULTILINE)
+            if m:
+                # Strip the thousands separators of newer rsync versions.
+                stats[key] = int(re.sub(r'\D', '', m.group(1)))
+        return stats
+
+    def _emit(self, event, **fields):
+        """Passes an event to the listener.  Every event carries its type,
+        the image name and version and a timestamp:
+
+        start, done: a sync starts or finished successfully (done also
+            carries the total seconds and the byte counts of the
+            transfer statistics)
+        error: a sync failed with the given exception class
+        phase: a phase (manifest, peers, chunks, transfer, verify or
+            commit) took the given number of seconds
+        progress: rsync reports bytes done of total for a file, with the
+            current rate in bytes per second and the ETA in seconds
+        """
+        if not self.listener:
+            return
+        fields.update({'event': event, 'image': self.image_name,
+                       'version': self.image_version, 'time': time.time()})
+        self.listener(fields)
+
+    def _timed(self, phase, func, *args, **kwargs):
+        """Calls func and emits the time it took as the given phase."""
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self._emit('phase', phase=phase, seconds=time.time() - start)
+
+    def _parse_progress(self, line, filename, last_emit):
+        """Emits a progress event if line is an rsync progress line.
+        Returns the time of the last event for the file."""
+        m = _rsync_progress_re.match(line)
+        if not m:
+            return last_emit
+        percent = int(m.group(2))
+        if percent < 100 and time.time() - last_emit < PROGRESS_INTERVAL:
+            return last_emit
+        done = int(re.sub(r'\D', '', m.group(1)))
+        total = None
+        if percent:
+            total = done * 100 // percent
+        rate = float(m.group(3).replace(',', '.')) * _rate_units[m.group(4)]
+        eta = int(m.group(5)) * 3600 + int(m.group(6)) * 60 + \
+              int(m.group(7))
+        self._emit('progress', file=filename, bytes=done, total=total,
+                   percent=percent, rate=int(rate), eta=eta)
+        return time.time()
+
+    def _relay_output(self, stream, filenames):
+        """Copies rsync's standard output to ours as it arrives (if
+        progress display is enabled), turns its progress lines into
+        events and returns its tail."""
+        output = ''
+        line = ''
+        filename, last_emit = None, 0
+        while True:
+            data = os.read(stream.fileno(), 4096)
+            if not data:
+                break
+            if self.progress:
+                sys.stdout.write(data)
+                sys.stdout.flush()
+            # The statistics are printed at the very end, no need to keep
+            # the whole progress output around.
+            output = (output + data)[-65536:]
+            if not self.listener:
+                continue
+            # rsync redraws the progress line with carriage returns.
+            lines = re.split(r'[\r\n]', line + data)
+            line = lines.pop()
+            for l in lines:
+                if l in filenames:
+                    filename, last_emit = l, 0
+                else:
+                    last_emit = self._parse_progress(l, filename, last_emit)
+        return output
+
+    def _staged_path(self, filename):
+        return os.path.join(self.image.partial_path(), filename)
+
+    def _stage_delta_basis(self):
+        """If the image is not installed yet and no partial transfer is
+        pending, hardlinks the configured basis VDI into the staging
+        directory, so that rsync's delta algorithm can reuse the blocks
+        both images have in common.  rsync replaces the link with a new
+        file, so the basis itself is never modified.  Returns True if a
+        basis was staged."""
+        staged_vdi = self._staged_path(self.image.vdi_filename())
+        if not self.basis or os.path.exists(self.image.vdi_path()) or \
+           os.path.exists(staged_vdi):
+            return False
+        try:
+            os.link(self.basis, staged_vdi)
+        except OSError, e:
+            self.logger.debug('Cannot use %s as delta basis: %s',
+                              self.basis, e)
+            return False
+        self.logger.info('Using %s as delta basis', self.basis)
+        return True
+
+    def _unstage_delta_basis(self):
+        # If the transfer got interrupted, rsync already replaced the link
+        # with the partial file, which is kept to resume from.
+        staged_vdi = self._staged_path(self.image.vdi_filename())
+        if os.path.exists(staged_vdi) and \
+           os.path.samefile(self.basis, staged_vdi):
+            os.unlink(staged_vdi)
+
+    def _run_rsync(self, source, destination, filenames, extra_args=[],
+                   optional=[]):
+        """Fetches the given files relative to the source URL into the
+        destination directory within a single rsync session, which also
+        serves as the presence check.  Raises ImageNotFoundError if rsync
+        returns with a failure of 23 (which is caused by ENOENT, among
+        others) and reports one of the files as missing, or RsyncError
+        if rsync returns with any other error.  Files in optional may be
+        missing without error.  Returns rsync's output."""
+        args = ['rsync', '--times', '--stats', '--files-from=-'] + extra_args
+        if self.progress or self.listener:
+            args.append('--progress')
+        if self.bwlimit:
+            args.append('--bwlimit=%d' % self.bwlimit)
+        # The trailing slashes make rsync treat both ends as directories,
+        # relative to which the file list is interpreted.
+        args += [source, destination + '/']
+        # stderr goes to a file, so that it cannot block rsync while we
+        # are reading its standard output.
+        stderr_file = tempfile.TemporaryFile()
+        try:
+            p = subprocess.Popen(args, stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE, stderr=stderr_file)
+            p.stdin.write('\n'.join(filenames) + '\n')
+            p.stdin.close()
+            output = self._relay_output(p.stdout, filenames)
+            p.wait()
+            stderr_file.seek(0)
+            stderr = stderr_file.read()
+        finally:
+            stderr_file.close()
+        if p.returncode != 0:
+            missing = self._parse_missing_files(stderr)
+            # Besides the missing files, rsync only prints its summary line
+            # if there were no other errors.
+            errors = [line for line in stderr.splitlines()
+                      if line.startswith('rsync:')]
+            if p.returncode == 23 and missing and \
+               len(errors) == len(missing) and \
+               not [f for f in missing if f not in optional]:
+                self.logger.debug('Optional files missing: %s',
+                                  ', '.join(missing))
+                return output
+            sys.stderr.write(stderr)
+            if p.returncode == 23 and missing:
+                raise ImageNotFoundError, ', '.join(missing)
+            raise RsyncError, p.returncode
+        return output
+
+    def _sync_files(self, filenames, ignore_times=False, optional=[]):
+        """Fetches the given files of the image from the rsync server into
+        the staging directory.  Interrupted transfers are kept (--partial)
+        and used as basis by the next run, so only the missing blocks are
+        fetched again.  The installed files are used as basis otherwise
+        (--copy-dest, which is relative to the staging directory)."""
+        # --sparse turns runs of zeros into holes on the local disk.
+        extra_args = ['--partial', '--copy-dest=..', '--sparse']
+        if ignore_times:
+            extra_args.append('--ignore-times')
+        output = self._run_rsync(self._construct_url(''),
+                                 self.image.partial_path(), filenames,
+                                 extra_args, optional)
+        self.logger.debug('Image found on the server.')
+        self.stats = self._parse_stats(output)
+
+    def _fetch_chunks(self, store, digests):
+        """Fetches the given chunks from the chunk store on the server in
+        a single rsync session and verifies them."""
+        if not os.path.exists(store.path):
+            os.makedirs(store.path, 0755)
+        # --files-from implies --relative, so rsync creates the
+        # subdirectories of the store as needed.
+        self._run_rsync('/'.join([self.config.baseurl, 'chunks', '']),
+                        store.path,
+                        [store.relative_path(digest)
+                         for digest in sorted(digests)])
+        for digest in digests:
+            if not store.verify(digest):
+                raise ImageVerificationError, digest
+
+    def _fetch_manifest(self):
+        """Fetches the .cfg and the chunk manifest of the image from the
+        server into the staging directory, once per sync.  Returns the
+        manifest or None if the server does not publish one."""
+        if self._manifest_fetched:
+            return self._manifest
+        manifest_filename = self.image.manifest_filename()
+        self._remove_staged_manifest()
+        if not self._remote_has(manifest_filename):
+            self._manifest_fetched = True
+            return None
+        self._timed('manifest', self._sync_files,
+                    [self.image.cfg_filename(), manifest_filename],
+                    optional=[manifest_filename])
+        self._read_staged_manifest()
+        return self._manifest
+
+    def _remove_staged_manifest(self):
+        # A manifest left over from an earlier sync of another version
+        # would not match the VDI.
+        staged_manifest = self._staged_path(self.image.manifest_filename())
+        if os.path.exists(staged_manifest):
+            os.unlink(staged_manifest)
+
+    def _read_staged_manifest(self):
+        staged_manifest = self._staged_path(self.image.manifest_filename())
+        if os.path.exists(staged_manifest):
+            try:
+                self._manifest = ChunkManifest.read(staged_manifest)
+            except ChunkManifestError:
+                raise ImageVerificationError, \
+                      self.image.manifest_filename()
+        self._manifest_fetched = True
+
+    def _sync_from_peers(self):
+        """Tries to fetch the VDI from the configured peers in order.  A
+        peer serves the target directory of a machine that already has
+        the image; as it does not know about versions, the copy is checked
+        against the chunk manifest published on the server.  Returns True
+        if one of the peers had the right version."""
+        if not self.config.peers:
+            return False
+        manifest = self._fetch_manifest()
+        if manifest is None:
+            self.logger.info('No chunk manifest published for %s, cannot '
+                             'verify copies from peers', self.image.name())
+            return False
+        staged_vdi = self._staged_path(self.image.vdi_filename())
+        for peer in self.config.peers:
+            self.logger.debug('Trying peer %s', peer)
+            try:
+                # Unreachable peers should not hold up the fallback to
+                # the next source for long.
+                output = self._run_rsync(
+                    '/'.join([peer, self.image_name, '']),
+                    self.image.partial_path(), [self.image.vdi_filename()],
+                    ['--partial', '--copy-dest=..', '--sparse',
+                     '--contimeout=%d' % PEER_TIMEOUT,
+                     '--timeout=%d' % PEER_TIMEOUT])
+            except (ImageNotFoundError, RsyncError), e:
+                self.logger.info('Peer %s failed: %s', peer,
+                                 e.__class__.__name__)
+                continue
+            # A copy of another version is not removed, but serves as delta
+            # basis for the next source.
+            if manifest.matches(staged_vdi):
+                self.logger.info('%s: fetched from peer %s',
+                                 self.image.name(), peer)
+                self.stats = self._parse_stats(output)
+                self._vdi_verified = True
+                return True
+            self.logger.info('Peer %s has a different version of %s', peer,
+                             self.image_name)
+        return False
+
+    def _sync_whole_image(self):
+        """Fetches the VDI through rsync's delta algorithm, together with
+        the chunk manifest to verify it against, if the server publishes
+        one."""
+        filenames = [self.image.cfg_filename(), self.image.vdi_filename()]
+        optional = []
+        if not self._manifest_fetched:
+            self._remove_staged_manifest()
+            if self._remote_has(self.image.manifest_filename()):
+                filenames.append(self.image.manifest_filename())
+                optional.append(self.image.manifest_filename())
+        # An installed older version is used as delta basis by rsync
+        # anyway.  A staged basis may happen to match the new image in size
+        # and mtime, so force rsync to compare the contents instead of
+        # skipping it.
+        staged = self._stage_delta_basis()
+        try:
+            self._sync_files(filenames, ignore_times=staged,
+                             optional=optional)
+        except:
+            if staged:
+                self._unstage_delta_basis()
+            raise
+        if not self._manifest_fetched:
+            self._read_staged_manifest()
+
+    def _sync_chunked(self):
+        """Fetches the image through the chunk transport: only chunks that
+        are neither part of an installed image nor fetched before are
+        transferred, then the VDI is reassembled in the staging directory.
+        Returns False if the server does not publish a chunk manifest for
+        the image."""
+        manifest = self._fetch_manifest()
+        if manifest is None:
+            self.logger.info('No chunk manifest published for %s, falling '
+                             'back to rsync', self.image.name())
+            return False
+        staged_vdi = self._staged_path(self.image.vdi_filename())
+        sources = installed_chunk_manifests(self.config)
+        for filename, installed in sources:
+            if installed.digests == manifest.digests and \
+               installed.size == manifest.size:
+                # An identical image is installed already, share it.
+                if os.path.exists(staged_vdi):
+                    os.unlink(staged_vdi)
+                os.link(filename, staged_vdi)
+                self.stats = {'literal': 0, 'matched': manifest.size}
+                return True
+        store = ChunkStore(chunk_store_path(self.config))
+        # Keep other syncs from pruning the store while we use it.
+        lock = lock_chunk_store(self.config, fcntl.LOCK_SH)
+        try:
+            assembler = ChunkAssembler(store, sources)
+            missing = assembler.missing(manifest)
+            self.logger.info('%s: fetching %d of %d chunks',
+                             self.image.name(), len(missing),
+                             len(manifest.digests))
+            if missing:
+                self._fetch_chunks(store, missing)
+            assembler.assemble(manifest, staged_vdi)
+        finally:
+            lock.close()
+        fetched = 0
+        for offset, length, digest in manifest.chunks():
+            if digest in missing:
+                fetched += length
+                missing.remove(digest)
+        self.stats = {'literal': fetched, 'matched': manifest.size - fetched}
+        return True
+
+    def _verify_staged_files(self):
+        """Checks the staged files before they are put into place.  If the
+        server publishes a chunk manifest, the VDI is verified against it.
+        Otherwise only its signature is checked: rsync already verified
+        the whole-file checksum of the transfer, this guards against
+        leftovers that are no images at all."""
+        staged_vdi = self._staged_path(self.image.vdi_filename())
+        if self._manifest is not None and not self._vdi_verified:
+            self.logger.info('Verifying %s', self.image.name())
+            if not self._manifest.matches(staged_vdi):
+                raise ImageVerificationError, self.image.vdi_filename()
+        vdi = open(self._staged_path(self.image.vdi_filename()), 'rb')
+        try:
+            vdi.seek(VDI_SIGNATURE_OFFSET)
+            signature = vdi.read(len(VDI_SIGNATURE))
+        finally:
+            vdi.close()
+        if signature != VDI_SIGNATURE:
+            raise ImageVerificationError, self.image.vdi_filename()
+        parser = ConfigParser()
+        parser.read(self._staged_path(self.image.cfg_filename()))
+        if not parser.has_section('vmparameters'):
+            raise ImageVerificationError, self.image.cfg_filename()
+
+    def _commit_staged_files(self):
+        """Moves the staged files into place.  Each rename is atomic, so
+        vbox-invoke either sees the old or the new file, but never a
+        truncated one."""
+        # The installed chunk manifest describes the installed VDI and is
+        # used to find chunks in it, so it must never refer to another
+        # version.  Remove it (and the verification result based on it)
+        # first and install the new one (if any) only after the VDI.
+        for path in [self.image.verified_path(), self.image.manifest_path()]:
+            if os.path.exists(path):
+                os.unlink(path)
+        for filename in [self.image.vdi_filename(),
+                         self.image.manifest_filename(),
+                         self.image.cfg_filename()]:
+            staged = self._staged_path(filename)
+            if not os.path.exists(staged):
+                continue
+            target = self.image._target_path(filename)
+            if os.path.exists(target) and os.path.samefile(staged, target):
+                # rename() would do nothing at all for the same file.
+                os.unlink(staged)
+                continue
+            # Make it publically readable, do not inherit the permission
+            # even if copied from the local disk.
+            os.chmod(staged, 0644)
+            os.rename(staged, target)
+        os.rmdir(self.image.partial_path())
 
     def sync(self):
-        self._check_presence()
+        start = time.time()
+        self._emit('start')
+        try:
+            self._sync()
+        except Exception, e:
+            self._emit('error', error=e.__class__.__name__)
+            raise
+        self._emit('done', seconds=time.time() - start,
+                   literal=self.stats.get('literal'),
+                   matched=self.stats.get('matched'))
+
+    def _sync(self):
+        self._timed('catalog', self._check_remote_files)
         self._ensure_target_directory()
         self._check_target_writeable()
-        self.logger.info('Syncing image')
-        self._sync_file(self._construct_url(self.image.cfg_filename()),
-                        self.image.cfg_path())
-        self._sync_file(self._construct_url(self.image.vdi_filename()),
-                        self.image.vdi_path())
-
-class VBoxInvocationError(Exception):
-    pass
+        self._remove_stale_partials()
+        self.logger.info('Syncing image %s', self.image.name())
+        synced = self._timed('peers', self._sync_from_peers)
+        if not synced and self.config.transport == 'chunks':
+            synced = self._timed('chunks', self._sync_chunked)
+        if not synced:
+            self._timed('transfer', self._sync_whole_image)
+        self._timed('verify', self._verify_staged_files)
+        self._timed('commit', self._commit_staged_files)
+        if self._manifest is not None:
+            self.image.mark_verified(self._manifest)
+        checksum = None
+        if self._manifest is not None:
+            checksum = self._manifest.digest()
+        self.image.update_catalog('record_sync', self.image_version,
+                                  os.path.getsize(self.image.vdi_path()),
+                                  checksum)
+        self.image.prepare_data_disk_template()
+        if 'literal' in self.stats and 'matched' in self.stats:
+            self.logger.info('%s: %d bytes transferred, %d bytes reused '
+                             'from the local copy', self.image.name(),
+                             self.stats['literal'], self.stats['matched'])
+        self.image.log_disk_usage()
+
+class VBoxImageSyncPool(object):
+    """Syncs a batch of images concurrently with a bounded number of
+    worker threads.  The global bandwidth limit (in KB/s) is split evenly
+    between the workers, so that all transfers together never exceed it.
+    A failing image does not abort the others; its exception is recorded
+    in the errors dict, keyed by the image object."""
+
+    def __init__(self, images, jobs=1, bwlimit=None, listener=None):
+        self.images = list(images)
+        self.jobs = max(1, min(jobs, len(self.images)))
+        self.bwlimit = bwlimit
+        self.listener = listener
+        self.logger = Logger()
+        self.errors = {}
+        self._lock = threading.Lock()
+        # Summed up rsync statistics of all successful syncs.
+        self.stats = {'literal': 0, 'matched': 0}
+
+    def _worker_bwlimit(self):
+        if not self.bwlimit:
+            return None
+        # rsync treats a limit of 0 as unlimited, so never go below 1.
+        return max(1, self.bwlimit // self.jobs)
+
+    def _worker(self, queue):
+        while True:
+            try:
+                image = queue.get_nowait()
+            except Queue.Empty:
+                return
+            sync = VBoxImageSync(image, bwlimit=self._worker_bwlimit(),
+                                 progress=(self.jobs == 1),
+                                 listener=self.listener)
+            try:
+                sync.sync()
+            except Exception, e:
+                self.logger.error('Syncing %s failed: %s', image.name(),
+                                  e.__class__.__name__)
+                self._lock.acquire()
+                try:
+                    self.errors[image] = e
+                finally:
+                    self._lock.release()
+            else:
+                self.logger.info('Synced %s', image.name())
+                self._lock.acquire()
+                try:
+                    for key in self.stats:
+                        self.stats[key] += sync.stats.get(key, 0)
+                finally:
+                    self._lock.release()
 
-def guarded_vboxmanage_call(args):
-    cmdline = ['VBoxManage', '-nologo', '-convertSettingsBackup'] + args
-    retcode = subprocess.call(cmdline)
+    def sync(self):
+        """Syncs all images and returns the dict of failed images."""
+        queue = Queue.Queue()
+        for image in self.images:
+            queue.put(image)
+        workers = []
+        for i in range(self.jobs):
+            worker = threading.Thread(target=self._worker, args=(queue,))
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join()
+        self.logger.info('%d bytes transferred, %d bytes reused from local '
+                         'copies', self.stats['literal'],
+                         self.stats['matched'])
+        # Keep fetched chunks around for the next attempt if anything
+        # failed.
+        if self.images and not self.errors:
+            prune_chunk_store(self.images[0].config)
+        return self.errors
+
+def data_disk_template_path(config):
+    if config.templates:
+        return config.templates
+    return os.path.join(config.target, '.templates')
+
+def chunk_store_path(config):
+    return os.path.join(config.target, '.chunks')
+
+def installed_chunk_manifests(config):
+    """Returns (VDI path, chunk manifest) pairs of all installed images
+    that were synced through the chunk transport.  Together with the chunk
+    store they are the local sources of chunks."""
+    sources = []
+    if not os.path.exists(config.target):
+        return sources
+    for image_name in os.listdir(config.target):
+        vdi = os.path.join(config.target, image_name, '%s.vdi' % image_name)
+        manifest = vdi + MANIFEST_SUFFIX
+        if not os.path.exists(vdi) or not os.path.exists(manifest):
+            continue
+        try:
+            sources.append((vdi, ChunkManifest.read(manifest)))
+        except ChunkManifestError:
+            continue
+    return sources
+
+def lock_chunk_store(config, operation):
+    """Locks the chunk store with the given flock operation and returns
+    the open lock file, which holds the lock until it is closed.  Syncs
+    using the store take a shared lock, pruning it takes an exclusive
+    one.  The lock file lives next to the store, which is removed as a
+    whole."""
+    lock = open(chunk_store_path(config) + '.lock', 'w')
+    try:
+        fcntl.flock(lock.fileno(), operation)
+    except:
+        lock.close()
+        raise
+    return lock
+
+def prune_chunk_store(config):
+    """Empties the local chunk store.  Once an image is assembled, the
+    installed VDI serves as source for its chunks, so keeping them in
+    the store would only duplicate its data.  If another sync is using
+    the store, it is left alone; a later sync prunes it."""
+    if not os.path.exists(chunk_store_path(config)):
+        return
+    try:
+        lock = lock_chunk_store(config, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError, e:
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+        Logger().debug('Chunk store in use, not pruning it.')
+        return
+    try:
+        ChunkStore(chunk_store_path(config)).clear()
+    finally:
+        lock.close()
+
+def _detach_sync(logfile):
+    """Continues the calling process as a daemon that logs to logfile, so
+    that the package installation that triggered the sync can proceed."""
+    if os.fork() > 0:
+        os._exit(0)
+    os.setsid()
+    if os.fork() > 0:
+        os._exit(0)
+    null = os.open('/dev/null', os.O_RDONLY)
+    log = os.open(logfile, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0644)
+    os.dup2(null, 0)
+    os.dup2(log, 1)
+    os.dup2(log, 2)
+    os.close(null)
+    os.close(log)
+
+def _lower_sync_priority():
+    """Puts the process and thus rsync into the idle CPU and I/O scheduling
+    classes, so that users working on the machine do not notice it."""
+    os.nice(19)
+    # There is no Python interface to ioprio_set, so use util-linux.
+    retcode = subprocess.call(['ionice', '-c', '3', '-p', str(os.getpid())])
     if retcode != 0:
-        raise VBoxInvocationError, ' '.join(cmdline)
+        Logger().debug('Could not set idle I/O priority.')
+
+def schedule_sync(config):
+    """Applies the [schedule] settings before syncing: hands the sync off
+    to the background, waits a random time of up to config.jitter seconds
+    and for other background syncs and lowers the priority.  Returns the
+    lock file of background syncs, which must be kept open while
+    syncing."""
+    lock = None
+    if config.background:
+        Logger().info('Continuing in the background, logging to %s',
+                      config.logfile)
+        _detach_sync(config.logfile)
+    if config.jitter:
+        # Spread the load of machines that got upgraded at the same time.
+        # This happens before queueing up, so that the syncs queued by
+        # one upgrade wait for their jitter concurrently, not one after
+        # the other.
+        delay = random.uniform(0, config.jitter)
+        Logger().info('Waiting %d seconds before syncing', delay)
+        time.sleep(delay)
+    if config.background:
+        # Background syncs form a queue, one sync at a time.
+        lock = open(os.path.join(config.target, '.sync-lock'), 'w')
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+    if config.idle:
+        _lower_sync_priority()
+    return lock
+
+class ProgressLog(object):
+    """A progress listener that appends every event as a line of JSON to
+    the given file.  It may be shared by concurrent syncs."""
+
+    def __init__(self, filename):
+        self._file = open(filename, 'a')
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        self._lock.acquire()
+        try:
+            self._file.write(json.dumps(event) + '\n')
+            self._file.flush()
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self._file.close()
+
+class VBoxRemoteCatalog(object):
+    """The listing of the images and versions on the rsync server, fetched
+    in one recursive rsync run and cached for config.catalog_ttl seconds,
+    in the target directory if it is writeable and in memory otherwise."""
+
+    def __init__(self, config):
+        self.config = config
+        self.logger = Logger()
+        self._lock = threading.Lock()
+        self._files = None
+        self._fetched = None
+        # Whether the listing was fetched by this process, rather than
+        # read from the cache.
+        self.fetched_here = False
+
+    def cache_path(self):
+        return os.path.join(self.config.target, '.remote-catalog')
+
+    def _read_cache(self):
+        try:
+            f = open(self.cache_path())
+        except IOError:
+            return
+        try:
+            try:
+                cache = json.load(f)
+            except ValueError:
+                return
+        finally:
+            f.close()
+        if cache.get('baseurl') == self.config.baseurl:
+            self._files = dict([(str(path), size) for (path, size)
+                                in cache['files'].items()])
+            self._fetched = cache['fetched']
+
+    def _write_cache(self):
+        directory = os.path.dirname(self.cache_path())
+        try:
+            (handle, tmp) = tempfile.mkstemp('', '.remote-catalog-',
+                                             directory)
+        except OSError, e:
+            self.logger.debug('Cannot cache the remote catalog: %s', e)
+            return
+        f = os.fdopen(handle, 'w')
+        try:
+            json.dump({'baseurl': self.config.baseurl,
+                       'fetched': self._fetched, 'files': self._files}, f)
+        finally:
+            f.close()
+        os.chmod(tmp, 0644)
+        os.rename(tmp, self.cache_path())
+
+    def _fetch(self):
+        """Lists the files of all image versions on the server.  The chunk
+        store and anything below the version directories is left out."""
+        args = ['rsync', '--list-only', '--recursive', '--exclude=/chunks/',
+                '--exclude=/*/*/*/', self.config.baseurl.rstrip('/') + '/']
+        p = subprocess.Popen(args, stdout=subprocess.PIPE)
+        output = p.communicate()[0]
+        if p.returncode != 0:
+            raise RsyncError, p.returncode
+        files = {}
+        for line in output.splitlines():
+            m = _rsync_list_re.match(line)
+            if m and m.group(2).count('/') == 2:
+                size = int(m.group(1).replace(',', '').replace('.', ''))
+                files[m.group(2)] = size
+        return files
+
+    def _refresh(self):
+        self._files = self._fetch()
+        self._fetched = time.time()
+        self.fetched_here = True
+        self._write_cache()
+
+    def refresh(self):
+        """Fetches the listing from the server, regardless of the age of
+        the cached one."""
+        self._lock.acquire()
+        try:
+            self._refresh()
+        finally:
+            self._lock.release()
+
+    def is_fresh(self):
+        return self._fetched is not None and \
+               0 <= time.time() - self._fetched < self.config.catalog_ttl
+
+    def files(self):
+        """Returns a dict mapping the paths of all files on the server
+        (image/version/filename) to their sizes."""
+        self._lock.acquire()
+        try:
+            if not self.is_fresh():
+                self._read_cache()
+            if not self.is_fresh():
+                self._refresh()
+            return self._files
+        finally:
+            self._lock.release()
+
+    def images(self):
+        """Returns a dict mapping image names to the list of their
+        versions, oldest first."""
+        images = {}
+        for path in self.files():
+            (image_name, image_version, filename) = path.split('/')
+            versions = images.setdefault(image_name, [])
+            if image_version not in versions:
+                versions.append(image_version)
+        for versions in images.values():
+            versions.sort(key=DebianVersion)
+        return images
+
+    def latest_version(self, image_name):
+        """Returns the latest version of the image or None."""
+        versions = self.images().get(image_name)
+        if not versions:
+            return None
+        return versions[-1]
+
+    def image_files(self, image_name, image_version):
+        """Returns a dict mapping the names of the files of the image
+        version to their sizes, empty if the server does not have it."""
+        prefix = '%s/%s/' % (image_name, image_version)
+        image_files = {}
+        for path, size in self.files().items():
+            if path.startswith(prefix):
+                image_files[path[len(prefix):]] = size
+        return image_files
+
+    def has_image(self, image_name, image_version):
+        return '%s.vdi' % image_name in \
+               self.image_files(image_name, image_version)
+
+    def size(self, image_name, image_version):
+        """Returns the total size of the files of the image version."""
+        return sum(self.image_files(image_name, image_version).values())
+
+_remote_catalogs = {}
+_remote_catalogs_lock = threading.Lock()
+
+def RemoteCatalog(config):
+    """Returns the remote catalog of the server, shared by all syncs from
+    it within the process."""
+    _remote_catalogs_lock.acquire()
+    try:
+        key = (config.baseurl, config.target)
+        if key not in _remote_catalogs:
+            _remote_catalogs[key] = VBoxRemoteCatalog(config)
+        return _remote_catalogs[key]
+    finally:
+        _remote_catalogs_lock.release()
+
+def read_sync_manifest(manifest):
+    """Reads (image name, image version) pairs from a file object,
+    one whitespace-separated pair per line.  Empty lines and lines
+    starting with a hash are ignored."""
+    pairs = []
+    for line in manifest:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split()
+        if len(fields) != 2:
+            raise ValueError, 'invalid manifest line: %s' % line
+        pairs.append(tuple(fields))
+    return pairs
+
+def run_parallel(func, items, jobs):
+    """Calls func for every item in up to jobs threads.  Returns a dict
+    mapping the items for which func raised an exception to it."""
+    queue = Queue.Queue()
+    for item in items:
+        queue.put(item)
+    errors = {}
+
+    def worker():
+        while True:
+            try:
+                item = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                func(item)
+            except Exception, e:
+                errors[item] = e
+
+    threads = []
+    for i in range(max(1, min(jobs, len(items)))):
+        thread = threading.Thread(target=worker)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return errors
+
+def parse_size(value):
+    """Parses a size in bytes with an optional K, M, G or T suffix."""
+    m = re.match(r'^\s*(\d+)\s*([KMGT]?)B?\s*$', value, re.IGNORECASE)
+    if not m:
+        raise ValueError, 'invalid size: %s' % value
+    return int(m.group(1)) * _size_units[m.group(2).upper()]
+
+def _open_files():
+    """Returns the set of the files opened by any process we may look
+    at, as far as /proc tells."""
+    files = set()
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        fd_dir = os.path.join('/proc', pid, 'fd')
+        try:
+            fds = os.listdir(fd_dir)
+        except OSError:
+            continue
+        for fd in fds:
+            try:
+                files.add(os.readlink(os.path.join(fd_dir, fd)))
+            except OSError:
+                # The process closed it or exited meanwhile.
+                continue
+    return files
+
+class VBoxImageCache(object):
+    """Keeps the images in the target directory within a budget of bytes
+    allocated on disk by evicting the least recently used ones.  Evicted
+    images keep their configuration file, so that their package stays
+    intact and vbox-invoke can sync them again."""
+
+    def __init__(self, config):
+        self.config = config
+        self.logger = Logger()
+
+    def _images(self):
+        """Returns (last use, bytes allocated, image) for every image with
+        a VDI.  An image was last used when it was last started according
+        to the catalog or, as starts by unprivileged users are not
+        recorded there, when the VDI was last read."""
+        try:
+            catalog = ImageCatalog(self.config.target).images()
+        except CatalogError, e:
+            self.logger.debug('Cannot read the image catalog: %s', e)
+            catalog = {}
+        images = []
+        for image in VBoxImageFinder(self.config).find_images():
+            st = os.stat(image.vdi_path())
+            last_used = st.st_atime
+            entry = catalog.get(image.image_name)
+            if entry and entry['last_used']:
+                last_used = max(last_used, entry['last_used'])
+            images.append((last_used, st.st_blocks * 512, image))
+        return images
+
+    def usage(self):
+        """Returns the number of bytes allocated for all images."""
+        return sum([allocated for (last_used, allocated, image)
+                    in self._images()])
+
+    def evict(self, budget, keep=()):
+        """Evicts images until all images together fit into budget bytes.
+        Pinned images, the images named in keep and images in use by a
+        running VM are never evicted.  Returns the names of the evicted
+        images and the bytes reclaimed."""
+        images = self._images()
+        usage = sum([allocated for (last_used, allocated, image) in images])
+        if usage <= budget:
+            return [], 0
+        images.sort()
+        in_use = _open_files()
+        protected = set(self.config.pinned) | set(keep)
+        evicted, reclaimed = [], 0
+        for last_used, allocated, image in images:
+            if usage <= budget:
+                break
+            if image.image_name in protected:
+                continue
+            if os.path.realpath(image.vdi_path()) in in_use:
+                self.logger.debug('Not evicting %s, it is in use',
+                                  image.name())
+                continue
+            self.logger.info('Evicting %s, last used %s, %d MB',
+                             image.name(), time.ctime(last_used),
+                             allocated // (1024 * 1024))
+            image.evict()
+            evicted.append(image.image_name)
+            reclaimed += allocated
+            usage -= allocated
+        if usage > budget:
+            self.logger.warning('Images use %d MB, more than the budget of '
+                                '%d MB', usage // (1024 * 1024),
+                                budget // (1024 * 1024))
+        return evicted, reclaimed
 
 class VBoxImageFinder(object):
     def __init__(self, config):
         self.config = config
 
-    def find_images(self):
+    def find_images(self, evicted=False):
+        """Yields the images installed in the target directory and, if
+        evicted is true, also the evicted ones, which only have their
+        configuration file left."""
+        try:
+            catalog = ImageCatalog(self.config.target).images()
+        except CatalogError, e:
+            Logger().debug('Cannot read the image catalog: %s', e)
+            catalog = {}
+        packages = InstalledPackageIndex()
         for image_name in os.listdir(self.config.target):
-            if os.path.exists( os.path.join(self.config.target, image_name, "%s.vdi" % image_name)):
-                # We need to find the version. This is getting slightly messy
-                for package_name in [ "%s-vbox" % image_name,
-                                      "vbox-%s" % image_name,
-                                      image_name ]:
-                    if os.path.exists ( os.path.join("/usr/share/doc",package_name,"changelog.gz") ):
-                        break
-                if not package_name:
-                    raise PackageNotFoundError
-                yield VBoxImage(self.config, image_name, self._version_of( package_name ))
-
-    def _version_of(self, package_name):                    
-        dpkg_pipe = subprocess.Popen(["dpkg-query", "--showformat", "${Version}", "--show", package_name], stdout=subprocess.PIPE)
-        return dpkg_pipe.communicate()[0]
- 
+            image_path = os.path.join(self.config.target, image_name)
+            vdi = os.path.join(image_path, "%s.vdi" % image_name)
+            cfg = os.path.join(image_path, "%s.cfg" % image_name)
+            if os.path.exists(vdi) or (evicted and os.path.exists(cfg)):
+                # The version of the package wins, as a sync of a new
+                # version may have failed after the package was upgraded.
+                # Only images not installed from a package are taken from
+                # the catalog, or get an empty version.
+                package_name = packages.find_image_package(image_name)
+                version = packages.version_of(package_name)
+                if version is None and image_name in catalog:
+                    version = catalog[image_name]['version']
+                yield VBoxImage(self.config, image_name, version or '')
 
 class VBoxImage(object):
     def __init__(self, config, image_name, image_version):
@@ -175,15 +1210,13 @@ class VBoxImage(object):
 
         self.admin_mode = False
 
-        # For the purposes of the GUI, we also want to know the name of the
-        # Debian package that we were shipped in. We find out about that here,
-        # using some common sense
-        for package_name in [ "%s-vbox" % image_name,
-                              "vbox-%s" % image_name,
-                              image_name ]:
-            if os.path.exists ( os.path.join("/usr/share/doc",package_name,"changelog.gz") ):
-                self.package_name = package_name
-                break
+    def package_name(self):
+        """For the purposes of the GUI, we also want to know the name of
+        the Debian package that we were shipped in.  Looking it up queries
+        dpkg, so this is only done when needed.  None if the image was not
+        installed from a package."""
+        return InstalledPackageIndex().find_image_package(self.image_name)
+    package_name = property(package_name)
 
     def name(self):
         """ A descripive name of the image, for display in GUIs etc. """
@@ -195,6 +1228,9 @@ class VBoxImage(object):
     def vdi_filename(self):
         return '%s.vdi' % self.image_name
 
+    def manifest_filename(self):
+        return self.vdi_filename() + MANIFEST_SUFFIX
+
     def _target_path(self, filename=None):
         if self.admin_mode:
             path = self._vbox_home()
@@ -212,11 +1248,90 @@ class VBoxImage(object):
     def cfg_path(self):
         return self._target_path(self.cfg_filename())
 
-    def sync(self):
+    def manifest_path(self):
+        return self._target_path(self.manifest_filename())
+
+    def verified_path(self):
+        return self._target_path(self.vdi_filename() + '.verified')
+
+    def partial_path(self):
+        """The staging directory in which vbox-sync keeps the files while
+        they are being transferred."""
+        return self._target_path('.partial')
+
+    def _verification_key(self, manifest):
+        """The cached verification result is only valid as long as the
+        VDI stays the same file with the same size and mtime and is
+        checked against the same manifest."""
+        st = os.stat(self.vdi_path())
+        return '%d %d %d %s' % (st.st_ino, st.st_size, int(st.st_mtime),
+                                manifest.digest())
+
+    def is_verified(self, manifest):
+        if not os.path.exists(self.verified_path()):
+            return False
+        f = open(self.verified_path())
+        try:
+            return f.read().strip() == self._verification_key(manifest)
+        finally:
+            f.close()
+
+    def mark_verified(self, manifest):
+        try:
+            f = open(self.verified_path(), 'w')
+        except IOError, e:
+            if e.errno != errno.EACCES:
+                raise
+            # vbox-invoke is run by unprivileged users.
+            self.logger.debug('Cannot cache verification result: %s', e)
+            return
+        try:
+            f.write(self._verification_key(manifest) + '\n')
+        finally:
+            f.close()
+
+    def verify(self):
+        """Checks the installed VDI against the chunk manifest it was
+        synced with, unless it was verified before and did not change
+        since.  Returns False if there is no manifest to check against
+        and raises ImageVerificationError if the VDI does not match."""
+        if not os.path.exists(self.manifest_path()):
+            return False
+        try:
+            manifest = ChunkManifest.read(self.manifest_path())
+        except ChunkManifestError:
+            raise ImageVerificationError, self.manifest_filename()
+        if self.is_verified(manifest):
+            return True
+        self.logger.info('Verifying %s', self.name())
+        if not manifest.matches(self.vdi_path()):
+            raise ImageVerificationError, self.vdi_filename()
+        self.mark_verified(manifest)
+        return True
+
+    def update_catalog(self, method, *args):
+        """Calls the given method of the image catalog with the image name
+        and args.  The catalog is not writeable for unprivileged users,
+        which is fine."""
+        try:
+            getattr(ImageCatalog(self.config.target), method)(
+                self.image_name, *args)
+        except CatalogError, e:
+            self.logger.debug('Cannot update the image catalog: %s', e)
+
+    def log_disk_usage(self):
+        logical, allocated = disk_usage(self.vdi_path())
+        self.logger.info('%s: %d MB logical size, %d MB allocated on disk',
+                         self.name(), logical // (1024 * 1024),
+                         allocated // (1024 * 1024))
+
+    def sync(self, bwlimit=None, basis=None, listener=None):
         """This method syncs the image from the rsync server.  It delegates
         this to a VBoxImageSync object."""
-        sync = VBoxImageSync(self)
+        sync = VBoxImageSync(self, bwlimit=bwlimit, basis=basis,
+                             listener=listener)
         sync.sync()
+        prune_chunk_store(self.config)
 
     def register(self):
         self.logger.info('Registering the image with VirtualBox')
@@ -246,61 +1361,57 @@ class VBoxImage(object):
         VM with the passed size in megabytes.  The data disk will not be
         resized in any way if the given size differs from the on-disk
         image."""
-        # A temporary image we create.
-        data_disk_tmp = tempfile.NamedTemporaryFile()
-        data_disk = data_disk_tmp.name
         # The real image which will be used with VBox.
         data_disk_vdi = os.path.join(self._vbox_home(), 'VDI',
                                      '%s-data.vdi' % self.image_name)
         if os.path.exists(data_disk_vdi):
             # Do nothing.
             return
-        vmparameters = dict(self._read_cfg())
-        if not 'datadisksize' in vmparameters:
+        size = self._data_disk_size()
+        if size is None:
             # No data disk size specified, do not create a data disk.
-            print vmparameters
             return
-        size = int(vmparameters['datadisksize'])
         self.logger.info('Creating data disk image for %s.', self.image_name)
-        # First create an empty image full of zeros.  This needs some
-        # space in the temporary directory, but avoids that a template needs
-        # to be shipped separately.  VirtualBox is compressing the image
-        # when converting from RAW to VDI anyway (32M to 1M in tests with
-        # fat16).
-        ret = subprocess.call(['dd', 'if=/dev/zero', 'of=%s' % data_disk,
-                               'bs=1M', 'count=%d' % size])
-        # XXX: improve exceptions here
-        # XXX: catch stderr+stdout and only print it if something goes wrong
-        if ret != 0:
-            raise Exception, 'dd failed'
-        # Now create a DOS disk label.
-        # (The path to parted is explicitly specified, because /sbin is not
-        # always in the path.  Maybe this should be replaced by an
-        # environment modification later on.)
-        ret = subprocess.call(['/sbin/parted', data_disk, 'mklabel', 'msdos'])
-        if ret != 0:
-            raise Exception, 'parted-mklabel failed'
-        # Create a fat16 or fat32 partition, depending on the size.  parted
-        # complains if the partition is too tiny for fat32 but the minimum
-        # size is determined by a strange algorithm.  In tests it already
-        # worked with 64M, but not with 32M.  It's probably not advisable
-        # to use fat32 on such tiny images anyway.
-        if size >= 128:
-            fs_type = 'fat32'
-        else:
-            fs_type = 'fat16'
-        ret = subprocess.call(['/sbin/parted', data_disk, 'mkpartfs', 'primary',
-                               fs_type, '1', str(size)])
-        if ret != 0:
-            raise Exception, 'parted-mkpartfs failed'
-        # Now convert it using VBoxManage.
-        guarded_vboxmanage_call(['convertfromraw', '-format', 'VDI',
-                                 data_disk, data_disk_vdi])
-        # This destroys the temporary image.
-        data_disk_tmp.close()
+        # The image is copied from the shared template if there is one and
+        # otherwise written directly as a sparse VDI containing just the
+        # partition table and an empty FAT filesystem.  Write it under a
+        # temporary name first, so that an interrupted run does not leave
+        # a broken disk behind that would be used from then on.
+        (handle, data_disk_tmp) = \
+            tempfile.mkstemp('.vdi', '.data-', os.path.dirname(data_disk_vdi))
+        os.close(handle)
+        try:
+            templates = DataDiskTemplates(data_disk_template_path(self.config))
+            if not templates.copy_to(data_disk_tmp, size):
+                create_data_disk(data_disk_tmp, size)
+            os.rename(data_disk_tmp, data_disk_vdi)
+        except:
+            os.unlink(data_disk_tmp)
+            raise
         # data_disk_vdi is now a disk usable for D:
         self.disks['data'] = data_disk_vdi
 
+    def _data_disk_size(self):
+        """Returns the size of the data disk in megabytes as given in the
+        configuration file of the image or None if it has none."""
+        vmparameters = dict(self._read_cfg())
+        if not 'datadisksize' in vmparameters:
+            return None
+        return int(vmparameters['datadisksize'])
+
+    def prepare_data_disk_template(self):
+        """Creates the shared template for the data disk of this image, so
+        that users get their data disk by copying it."""
+        size = self._data_disk_size()
+        if size is None:
+            return
+        templates = DataDiskTemplates(data_disk_template_path(self.config))
+        try:
+            templates.ensure(size)
+        except (IOError, OSError), e:
+            # Data disks are still created on demand without the template.
+            self.logger.warning('Cannot create data disk template: %s', e)
+
     def _register_disks(self):
         for disk in self.disks:
             if disk == 'system' and not self.admin_mode:
@@ -322,12 +1433,11 @@ class VBoxImage(object):
         return parser.items('vmparameters')
 
     def _register_vm(self):
-        # XXX: Maybe update settings only after upgrades?  That's the only
-        # part that would require passing in the version on the command-line.
         # TODO: We really need to change this, as the immutability of the
         # system disk creates differential images that are assigned to the
         # ide port instead
         uuid = self.vbox_registry.create_vm(self.image_name)
+        reconfiguration = self.vbox_registry.reconfigure_vm(uuid)
         # ConfigParser's items method gives us a list of tuples.  The map
         # will unquote the values (i.e. remove spaces and quotes) and prepend
         # a dash to the keys to act as the parameters.  In the end it's casted
@@ -336,7 +1446,7 @@ class VBoxImage(object):
                               self._read_cfg()))
         if '-datadisksize' in parameters:
             del parameters['-datadisksize']
-        self.vbox_registry.modify_vm(uuid, parameters)
+        reconfiguration.update(parameters)
         for disk in self.disks:
             # TODO: improve this
             if disk == 'system':
@@ -346,11 +1456,52 @@ class VBoxImage(object):
             else:
                 raise NotImplementedError, 'disks other than system and data '\
                                            'implemented'
-            self.vbox_registry.attach_hdd(uuid, ide_port, self.disks[disk])
+            reconfiguration.attach_hdd(ide_port, self.disks[disk])
+        reconfiguration.apply()
+
+    def is_evicted(self):
+        return os.path.exists(self.cfg_path()) and \
+               not os.path.exists(self.vdi_path())
+
+    def evict(self):
+        """Removes the VDI to save space, but leaves the configuration
+        file, which belongs to the package of the image."""
+        for path in [self.vdi_path(), self.manifest_path(),
+                     self.verified_path()]:
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def _restore_privileged(self):
+        """Asks vbox-sync to restore the image with root privileges, which
+        the sudoers file shipped with this package grants everybody for
+        this purpose.  sudo must not prompt for a password."""
+        self.logger.info('%s was evicted, asking vbox-sync to restore it',
+                         self.name())
+        try:
+            retcode = subprocess.call(RESTORE_COMMAND + [self.image_name])
+        except OSError, e:
+            self.logger.debug('Cannot run sudo: %s', e)
+            raise ImageEvictedError
+        if retcode != 0 or self.is_evicted():
+            raise ImageEvictedError
+
+    def _resync_evicted(self):
+        if not os.access(self._target_path(), os.W_OK):
+            self._restore_privileged()
+            return
+        self.logger.info('%s was evicted, syncing it again', self.name())
+        self.sync()
+        if self.config.budget is not None:
+            VBoxImageCache(self.config).evict(self.config.budget,
+                                              keep=[self.image_name])
 
     def _ensure_system_disk(self):
+        if self.is_evicted():
+            self._resync_evicted()
         if not os.path.exists(self.vdi_path()):
             raise ImageNotFoundError
+        if self.config.verify:
+            self.verify()
         self.disks['system'] = self.vdi_path()
 
     def invoke(self, use_exec=True):
@@ -359,12 +1510,14 @@ class VBoxImage(object):
         true, the current process will be replaced.
         """
         self._ensure_vbox_home()
-        self.vbox_registry = VBoxRegistry(self._vbox_home())
+        self.vbox_registry = VBoxRegistry(self._vbox_home(),
+                                          self.config.backend)
         self._ensure_system_disk()
         self._ensure_data_disk()
         self._register_disks()
         self._register_vm()
-        self.vbox_registry.garbage_collect_hdds(self.image_name)
+        self.garbage_collect()
+        self.update_catalog('record_use', self.image_version)
         # Using execlp to replace the current process image.
         # XXX: do we want that?  function does not return
         if use_exec:
@@ -374,6 +1527,21 @@ class VBoxImage(object):
         # TODO: make this configurable to either use SDL or VBox proper
         #os.execlp('vboxsdl', '-vm', self.image_name)
 
+    def garbage_collect(self):
+        """Removes the differential images left over from previous runs
+        of the VM and returns the number of removed images and the bytes
+        reclaimed."""
+        if not getattr(self, 'vbox_registry', None):
+            self.vbox_registry = VBoxRegistry(self._vbox_home(),
+                                              self.config.backend)
+        removed, reclaimed = \
+            self.vbox_registry.garbage_collect_hdds(self.image_name)
+        if removed:
+            self.logger.info('%s: removed %d unused differential images, '
+                             '%d MB reclaimed', self.image_name, removed,
+                             reclaimed // (1024 * 1024))
+        return removed, reclaimed
+
     def dispose(self):
         # NB: This does not clean up the data disks in the user home
         # directories.  OTOH there is no sane way to handle that,
@@ -382,6 +1550,13 @@ class VBoxImage(object):
             os.unlink(self.vdi_path())
         if os.path.exists(self.cfg_path()):
             os.unlink(self.cfg_path())
+        if os.path.exists(self.manifest_path()):
+            os.unlink(self.manifest_path())
+        if os.path.exists(self.verified_path()):
+            os.unlink(self.verified_path())
+        if os.path.exists(self.partial_path()):
+            shutil.rmtree(self.partial_path())
+        self.update_catalog('remove')
         # Remove the parent directory if empty.
         if os.path.exists(self._target_path()):
             try:
@@ -392,7 +1567,21 @@ class VBoxImage(object):
                 self.logger.warn('%s not empty, thus not removed.',
                                  self._target_path())
 
-    def prepare_admin_mode(self):
+    def _copy_progress_logger(self):
+        """Returns a progress callback for copy_sparse that logs every ten
+        percent."""
+        reported = [None]
+        def log(done, total):
+            step = (total and done * 100 // total or 100) // 10
+            if step != reported[0]:
+                self.logger.info('%s: %d%% copied', self.name(), step * 10)
+                reported[0] = step
+        return log
+
+    def prepare_admin_mode(self, progress=None):
+        """Copies the image into the admin VirtualBox home.  progress is
+        called with the bytes copied so far and the total while copying
+        the disk image."""
         assert not self.admin_mode
 
         sys_vdi = self.vdi_path()
@@ -405,11 +1594,15 @@ class VBoxImage(object):
         admin_vdi = self.vdi_path()
         admin_cfg = self.cfg_path()
 
-        shutil.copyfile(sys_vdi, admin_vdi)
+        copy_sparse(sys_vdi, admin_vdi, progress or self._copy_progress_logger())
         shutil.copyfile(sys_cfg, admin_cfg)
+        self.log_disk_usage()
 
-    def copy_image_files_to(self, target_directory):
-        shutil.copy(self.vdi_path(), target_directory)
+    def copy_image_files_to(self, target_directory, progress=None):
+        target_vdi = os.path.join(target_directory, self.vdi_filename())
+        copy_sparse(self.vdi_path(), target_vdi,
+                    progress or self._copy_progress_logger())
+        shutil.copymode(self.vdi_path(), target_vdi)
         shutil.copy(self.cfg_path(), target_directory)
 
     def leave_admin_mode(self):
@@ -424,49 +1617,172 @@ class VBoxImage(object):
         self.admin_mode = False
 
 
+class VBoxVMReconfiguration(object):
+    """Collects the settings and hard disk attachments of a VM and applies
+    them with as few VBoxManage calls as possible: one for the settings
+    and the detaching of disks and one for attaching the new disks.  Only
+    settings and disks that differ from the current state of the VM are
+    applied.
+
+    Every VBoxManage call is a process spawn that loads the whole
+    VirtualBox registry, which dominates the start time of a VM on slow
+    clients."""
+
+    def __init__(self, registry, identifier):
+        self.registry = registry
+        self.identifier = identifier
+        self.settings = {}
+        self.disks = {}
+
+    def update(self, parameters):
+        """Adds the dict of modifyvm parameters (with leading dashes) to
+        the settings to apply."""
+        self.settings.update(parameters)
+
+    def attach_hdd(self, ide_port, filename):
+        """Attaches the hard disk image to the given IDE port."""
+        self.disks[ide_port] = os.path.abspath(filename)
+
+    def _changed_settings(self, info):
+        """Returns the settings whose value differs from the one in the
+        machine-readable VM information."""
+        # The settings use the names of modifyvm, which differ from the
+        # ones in the VM information for some keys.
+        info_keys = {}
+        for key, replacement in self.registry._transform_vminfo_keys.items():
+            if replacement:
+                info_keys[replacement] = key
+        changed = {}
+        for key, value in self.settings.items():
+            name = key.lstrip('-')
+            if info.get(info_keys.get(name, name)) != str(value):
+                changed[key] = value
+        return changed
+
+    def _disks_to_attach(self, attached):
+        """Returns the IDE ports whose disk needs to be (re)attached.
+        Immutable disks are attached through a differential image, so a
+        disk is also left alone if the image attached is a child of it.
+        VirtualBox discards the changes in that child when the VM starts,
+        and children of earlier runs are removed by
+        VBoxRegistry.garbage_collect_hdds."""
+        ports = []
+        for ide_port in sorted(self.disks):
+            current = attached.get(ide_port)
+            if current == self.disks[ide_port]:
+                continue
+            if current is not None and \
+               self.registry.get_hdd_parent(current) == self.disks[ide_port]:
+                continue
+            ports.append(ide_port)
+        return ports
+
+    def apply(self):
+        """Applies all collected changes to the VM."""
+        info = self.registry.get_vm_info(self.identifier)
+        attached = self.registry.get_attached_hdds(self.identifier)
+        ports = self._disks_to_attach(attached)
+        detach = self._changed_settings(info)
+        self.registry.logger.debug('Changing %d of %d settings and %d of %d '
+                                   'disks of VM %s', len(detach),
+                                   len(self.settings), len(ports),
+                                   len(self.disks), self.identifier)
+        for ide_port in ports:
+            if ide_port in attached:
+                detach['-%s' % ide_port] = 'none'
+        if detach:
+            self.registry.modify_vm(self.identifier, detach)
+        attach = {}
+        for ide_port in ports:
+            attach['-%s' % ide_port] = self.disks[ide_port]
+        if attach:
+            self.registry.modify_vm(self.identifier, attach)
+        self.settings = {}
+        self.disks = {}
+
 class VBoxRegistry(object):
+    """Interface to the VirtualBox registry of VMs and media.
+
+    The lists of VMs and hard disks are read from VirtualBox once and then
+    kept as a snapshot that the mutating methods of this class update
+    themselves, as every VBoxManage call is expensive.  Changes done to
+    the registry behind our back require a call to invalidate().
+
+    VirtualBox is accessed through a backend (see itomig.vboxbackend),
+    by default VBoxManage (cli); the [virtualbox] backend setting selects
+    the Python API (api or auto) or the fake one for tests.  The
+    registry is read from the settings files directly if possible and
+    through the backend otherwise.  Changes always go through the
+    backend."""
+
     # XXX: handle failures
-    def __init__(self, vbox_home):
+    def __init__(self, vbox_home, backend='cli'):
         self.vbox_home = vbox_home
         self.logger = Logger()
         # TODO: pass this through subprocess
         if vbox_home:
             os.environ['VBOX_USER_HOME'] = vbox_home
-
-    def _get_list_value(self, line):
-        return line.split(' ', 1)[1].strip()
+        # The backend needs to be created after VBOX_USER_HOME is set, as
+        # the API connects to the VBoxSVC instance of that directory.
+        self.backend = create_backend(backend)
+        settings_home = None
+        if self.backend.settings_files:
+            settings_home = vbox_home or os.environ.get('VBOX_USER_HOME',
+                os.path.expanduser('~/.VirtualBox'))
+        self.settings = VBoxSettingsReader(settings_home)
+        # Snapshots of the registry: VM UUID to name and hard disk UUID to
+        # absolute location.  None if not loaded yet.
+        self._vms = None
+        self._hdds = None
+        # Machine-readable VM information by identifier.
+        self._vm_info = {}
+
+    def invalidate(self):
+        """Drops the registry snapshot, so that it is read again from
+        VirtualBox when needed."""
+        self._vms = None
+        self._hdds = None
+        self._vm_info = {}
+        self.settings.invalidate()
+
+    def _guarded_call(self, method, *args):
+        """Calls the backend method that changes the registry.  If it
+        fails, the registry may have been changed partially, so the
+        snapshot is dropped."""
+        try:
+            result = method(*args)
+        except VBoxInvocationError:
+            self.invalidate()
+            raise
+        # The snapshot is kept up to date by the caller, but the settings
+        # files changed.
+        self.settings.invalidate()
+        return result
+
+    def _settings_fallback(self, e):
+        self.logger.debug('Cannot read the VirtualBox settings, falling back '
+                          'to VBoxManage: %s', e)
 
     def get_vms(self):
-        p = subprocess.Popen(['VBoxManage', '-nologo',
-                              '-convertSettingsBackup',
-                              'list', 'vms'],
-                             stdout=subprocess.PIPE)
-        vms, current_name = {}, None
-        output = p.communicate()[0]
-        for line in output.splitlines():
-            # XXX: test if this is locale dependent
-            if line.startswith('Name:'):
-                current_name = self._get_list_value(line)
-            elif line.startswith('UUID:'):
-                uuid = self._get_list_value(line)
-                vms[uuid] = current_name
-            else:
-                m = re.match(r'"(.*)" {(.*)}', line)
-                if m:
-                    vms[m.group(2)] = m.group(1)
-        return vms
+        """Returns a dict mapping the UUIDs of all registered VMs to their
+        names."""
+        if self._vms is None:
+            try:
+                self._vms = self.settings.get_vms()
+            except VBoxSettingsError, e:
+                self._settings_fallback(e)
+                self._vms = self.backend.list_vms()
+        return dict(self._vms)
 
     def get_hdds(self):
-        p = subprocess.Popen(['VBoxManage', '-nologo',
-                              '-convertSettingsBackup',
-                              'list', 'hdds'],
-                             stdout=subprocess.PIPE)
-        output = p.communicate()[0]
-        hdds = []
-        for line in output.splitlines():
-            if line.startswith('Location:'):
-                hdds.append(self._get_list_value(line))
-        return hdds
+        """Returns the locations of all registered hard disk images."""
+        if self._hdds is None:
+            try:
+                self._hdds = self.settings.get_hdds()
+            except VBoxSettingsError, e:
+                self._settings_fallback(e)
+                self._hdds = self.backend.list_hdds()
+        return self._hdds.values()
 
     def create_vm(self, name):
         """Registers a new VM with VirtualBox and returns its UUID."""
@@ -475,28 +1791,67 @@ class VBoxRegistry(object):
             if vms[uuid] == name:
                 return uuid
         # VM does not exist already, create it in the registry.
-        p = subprocess.Popen(['VBoxManage', '-nologo',
-                              '-convertSettingsBackup',
-                              'createvm', '-name', name, '-register'],
-                             stdout=subprocess.PIPE)
-        output = p.communicate()[0]
-        for line in output.splitlines():
-            if line.startswith('UUID:'):
-                return self._get_list_value(line)
-        # TODO: No UUID found, something went wrong inside vbox.  We should
-        # raise an exception instead.
-        assert False
+        uuid = self._guarded_call(self.backend.create_vm, name)
+        self._vms[uuid] = name
+        # A new VM has nothing attached yet, no need to ask.
+        self._vm_info[uuid] = {}
+        return uuid
+
+    def get_vm_info(self, identifier):
+        """Returns the machine-readable information about the VM as a dict
+        with unquoted keys and values."""
+        if identifier not in self._vm_info:
+            info = {}
+            for line in self.backend.show_vm_info(identifier).splitlines():
+                if '=' not in line:
+                    continue
+                key, value = line.split('=', 1)
+                info[key.strip('"')] = value.strip('"')
+            self._vm_info[identifier] = info
+        return dict(self._vm_info[identifier])
+
+    def get_attached_hdds(self, identifier):
+        """Returns a dict mapping the IDE ports of the VM to the locations
+        of the hard disks attached to them."""
+        try:
+            return self.settings.get_attached_hdds(identifier)
+        except VBoxSettingsError, e:
+            self._settings_fallback(e)
+        info = self.get_vm_info(identifier)
+        attached = {}
+        for ide_port in ('hda', 'hdb', 'hdc', 'hdd'):
+            if info.get(ide_port, 'none') != 'none':
+                attached[ide_port] = info[ide_port]
+        return attached
+
+    def get_hdd_parent(self, location):
+        """Returns the location of the hard disk the differential image at
+        location was created from, or None if it is none or the settings
+        files cannot tell."""
+        location = os.path.normpath(location)
+        try:
+            hdds = self.settings.get_hdds()
+            for uuid in hdds:
+                if hdds[uuid] == location:
+                    return hdds.get(self.settings.get_parent(uuid))
+        except VBoxSettingsError, e:
+            self._settings_fallback(e)
+        return None
 
     def modify_vm(self, identifier, parameters):
         """Takes the VM identifier (either name or UUID) and a dict of
         parameters and adjusts the VM parameters accordingly through
         VBoxManage."""
-        # XXX: We should interact with vbox more sanely.  Sadly vbox's CLI
-        # interface is not machine-parseable, so that's hard.
-        arg_list = []
-        for key in parameters:
-            arg_list.extend([key, str(parameters[key])])
-        guarded_vboxmanage_call(['modifyvm', identifier] + arg_list)
+        self._guarded_call(self.backend.modify_vm, identifier, parameters)
+        # VirtualBox may store the values differently than they were
+        # passed (e.g. create differential images for attached disks), so
+        # read the VM information again when needed.
+        self._vm_info.pop(identifier, None)
+
+    def reconfigure_vm(self, identifier):
+        """Returns a VBoxVMReconfiguration to collect changes to the VM
+        that are applied together."""
+        return VBoxVMReconfiguration(self, identifier)
 
     def register_hdd(self, filename, disk_type='normal'):
         """Registers a VDI file with the VirtualBox media registry.
@@ -514,23 +1869,13 @@ class VBoxRegistry(object):
             return False
         self.logger.debug('Registering new hard disk image %s with type %s.',
                           absolute_filename, disk_type)
-        guarded_vboxmanage_call(['openmedium', 'disk',
-                                 os.path.abspath(filename),
-                                 '-type', disk_type])
+        self._guarded_call(self.backend.open_hdd, absolute_filename,
+                           disk_type)
+        # The UUID is not printed, key the new entry by its location until
+        # the registry is read again.
+        self._hdds[absolute_filename] = absolute_filename
         return True
 
-    def attach_hdd(self, identifier, ide_port, disk_identifier):
-        """Attaches a hard disk image to a VM ide port by detaching the old
-        and attaching the new image.  This works around failures by VirtualBox
-        if differential hard disks are already attached."""
-        # TODO: (IMPORTANT!) get rid of the differential disk leftover
-        # disconnect current HDD
-        guarded_vboxmanage_call(['modifyvm', identifier, '-%s' % ide_port,
-                                 'none'])
-        # attach the new one
-        guarded_vboxmanage_call(['modifyvm', identifier, '-%s' % ide_port,
-                                 disk_identifier])
-
     def _uuid_from_filename(self, filename):
         m = re.match(r'{(.+)}.vdi', os.path.basename(filename))
         if not m:
@@ -538,31 +1883,86 @@ class VBoxRegistry(object):
                   "Unknown filename type to convert to UUID: %s" % filename
         return m.group(1)
 
-    def garbage_collect_hdds(self, image_name):
-        """Checks if there are differential images leftovers from previous
-        attach/detach operations that are not currently associated to a VM."""
+    def _find_unused_hdds(self, candidates):
+        """Takes a dict of UUIDs to locations of differential images and
+        returns the unused ones as a list of lists of UUIDs that can be
+        closed concurrently, children before their parents, and the set
+        of UUIDs known to VirtualBox."""
+        try:
+            in_use = self.settings.get_hdds_in_use()
+            registered = set(self.settings.get_hdds())
+            levels = {}
+            for uuid in candidates:
+                if uuid not in in_use:
+                    depth = self.settings.get_depth(uuid)
+                    levels.setdefault(depth, []).append(uuid)
+            depths = levels.keys()
+            depths.sort()
+            depths.reverse()
+            return [levels[depth] for depth in depths], registered
+        except VBoxSettingsError, e:
+            self._settings_fallback(e)
+        unused = []
+        for uuid, location in candidates.items():
+            if not self.backend.is_hdd_in_use(location):
+                unused.append(uuid)
+        # Without the media tree neither registration nor parentage is
+        # known.  Close them one after the other.
+        return [[uuid] for uuid in unused], set(unused)
+
+    def garbage_collect_hdds(self, image_name, jobs=4):
+        """Removes the differential images left over from previous
+        attach/detach operations that are not currently associated to a
+        VM.  Unused images are determined from one snapshot of the
+        registry, closed in parallel and deleted in parallel.  Returns the
+        number of removed images and the bytes reclaimed."""
         snapshot_directory = os.path.join(self.vbox_home, 'Machines',
             image_name, 'Snapshots')
         if not os.path.exists(snapshot_directory):
-            return
+            return 0, 0
+        candidates = {}
         for filename in os.listdir(snapshot_directory):
             full_hdd_path = os.path.abspath(os.path.join(snapshot_directory,
                                                          filename))
-            p = subprocess.Popen(['VBoxManage', '-nologo',
-                                  '-convertSettingsBackup',
-                                  'showhdinfo', full_hdd_path],
-                             stdout=subprocess.PIPE)
-            output = p.communicate()[0]
-            if re.search(r'In use by VMs:', output):
-                continue
-            uuid = self._uuid_from_filename(filename)
-            Logger().info("Removing unused differential harddisk '%s'", uuid)
-            self.discard_hdd(uuid)
-            os.unlink(full_hdd_path)
+            candidates[self._uuid_from_filename(filename)] = full_hdd_path
+        levels, registered = self._find_unused_hdds(candidates)
+        close_jobs = jobs
+        if not self.backend.concurrent:
+            close_jobs = 1
+        closed = []
+        for level in levels:
+            close = [uuid for uuid in level if uuid in registered]
+            errors = run_parallel(self.backend.close_hdd, close, close_jobs)
+            for uuid in level:
+                if uuid in errors:
+                    self.logger.warning("Cannot close differential harddisk "
+                                        "'%s'", uuid)
+                else:
+                    closed.append(uuid)
+        self.invalidate()
+        sizes = {}
+        for uuid in closed:
+            sizes[uuid] = disk_usage(candidates[uuid])[1]
+        errors = run_parallel(lambda uuid: os.unlink(candidates[uuid]),
+                              closed, jobs)
+        reclaimed = 0
+        for uuid in closed:
+            if uuid in errors:
+                self.logger.warning("Cannot remove differential harddisk "
+                                    "'%s': %s", uuid, errors[uuid])
+            else:
+                self.logger.debug("Removed unused differential harddisk "
+                                  "'%s'", uuid)
+                reclaimed += sizes[uuid]
+        return len(closed) - len(errors), reclaimed
 
     def discard_hdd(self, identifier):
         """Unregisters a hard disk image from the VBox media registry."""
-        guarded_vboxmanage_call(['closemedium', 'disk', identifier])
+        self._guarded_call(self.backend.close_hdd, identifier)
+        if self._hdds is not None:
+            for key, location in self._hdds.items():
+                if identifier in (key, location):
+                    del self._hdds[key]
 
     # The machine-readable output of VBoxManage showvminfo needs severe fixups
     # to be used as input for modifyvm's command-line interface.  The following
@@ -583,43 +1983,66 @@ class VBoxRegistry(object):
         'hdd': False,
         }
 
+    def transform_vm_info(self, output):
+        """Yields the lines of the machine-readable VM information that
+        modifyvm accepts, with the keys renamed where needed.  Every key
+        is looked up once in _transform_vminfo_keys."""
+        for line in output.splitlines():
+            if '=' not in line:
+                continue
+            key = line.split('=', 1)[0]
+            replacement = self._transform_vminfo_keys.get(key.strip('"'))
+            if replacement is False:
+                continue
+            if replacement:
+                line = replacement + line[len(key):]
+            yield line
+
     def dump_vm_config(self, identifier, output_file=None, data_disk_size=None):
+        """Writes the configuration file of the VM to output_file, which
+        is either a file object or a filename, or to stdout."""
         # XXX: We can get rid of this ad-hoc configuration file if we switch to
         # the OVF format.
-        if output_file:
-            f = output_file
-        else:
+        # Query the VM first, so that no empty file is left behind if that
+        # fails.
+        output = self.backend.show_vm_info(identifier)
+        if output_file is None:
             f = sys.stdout
-        p = subprocess.Popen(['VBoxManage', '-nologo',
-                              '-convertSettingsBackup',
-                              'showvminfo', identifier, '-machinereadable'],
-                             stdout=subprocess.PIPE)
-        output = p.communicate()[0]
-        f.write("[vmparameters]\n")
-        for line in output.splitlines():
-            for pattern in self._transform_vminfo_keys:
-                if line is None:
-                    continue
-                if line.startswith(pattern):
-                    if self._transform_vminfo_keys[pattern] is False:
-                        line = None
-                    else:
-                        line = '%s%s' % (self._transform_vminfo_keys[pattern],
-                                         line[len(pattern):])
-            if not line:
-                continue
-            f.write(line)
-            f.write("\n")
-        if data_disk_size:
-            f.write("datadisksize=%s\n" % str(data_disk_size))
+        elif isinstance(output_file, basestring):
+            f = open(output_file, 'w')
+        else:
+            f = output_file
+        try:
+            f.write("[vmparameters]\n")
+            for line in self.transform_vm_info(output):
+                f.write(line)
+                f.write("\n")
+            if data_disk_size:
+                f.write("datadisksize=%s\n" % str(data_disk_size))
+        finally:
+            if f is not output_file and f is not sys.stdout:
+                f.close()
+
+    def dump_vm_configs(self, output_files, data_disk_size=None, jobs=4):
+        """Writes the configuration files of several VMs, given as a dict
+        mapping VM identifiers to filenames, with jobs VMs queried
+        concurrently.  Returns a dict mapping the identifiers of the VMs
+        that failed to the exceptions."""
+        if not self.backend.concurrent:
+            jobs = 1
+        return run_parallel(lambda identifier: self.dump_vm_config(
+                                identifier, output_files[identifier],
+                                data_disk_size),
+                            output_files.keys(), jobs)
 
 class Config(object):
     """Configuration object that reads ~/.config/vbox-sync.cfg
-    and /etc/vbox-sync.cfg iff they exist and overrides settings
-    based on the command-line options passed by the user."""
+    (unless system_only is true) and /etc/vbox-sync.cfg iff they exist
+    and overrides settings based on the command-line options passed by
+    the user."""
 
-    def __init__(self, options):
-        self._read_config_files()
+    def __init__(self, options, system_only=False):
+        self._read_config_files(system_only)
 
         if options:
             self._read_cmdline_options(options)
@@ -628,20 +2051,109 @@ class Config(object):
         logger.debug('Configuration:')
         logger.debug(' Rsync Base URL: %s', self.baseurl)
         logger.debug(' Target directory: %s', self.target)
-
-    def _read_config_files(self):
-        # Read configuration file.
+        logger.debug(' Transport: %s', self.transport)
+        logger.debug(' Peers: %s', ' '.join(self.peers))
+        logger.debug(' Remote catalog TTL: %d seconds', self.catalog_ttl)
+        logger.debug(' Sync jobs: %d', self.jobs)
+        logger.debug(' Bandwidth limit: %s', self.bwlimit)
+        logger.debug(' Partial file max. age: %d days', self.partial_max_age)
+        logger.debug(' Verify images: %s', self.verify)
+        logger.debug(' Data disk templates: %s',
+                     data_disk_template_path(self))
+        logger.debug(' Image budget: %s bytes', self.budget)
+        logger.debug(' Pinned images: %s', ' '.join(self.pinned))
+        logger.debug(' Start jitter: %d seconds', self.jitter)
+        logger.debug(' Idle priority: %s', self.idle)
+        logger.debug(' Background sync: %s', self.background)
+        logger.debug(' VirtualBox backend: %s', self.backend)
+
+    def _read_config_files(self, system_only):
+        # Read configuration file.  Privileged runs on behalf of users
+        # must not be configurable by them.
+        files = [SYSTEM_CONFIG]
+        if not system_only:
+            files.insert(0, os.path.expanduser('~/.config/vbox-sync.cfg'))
         file_config = ConfigParser()
-        file_config.read([os.path.expanduser('~/.config/vbox-sync.cfg'),
-                         '/etc/vbox-sync.cfg'])
+        file_config.read(files)
         self.baseurl = file_config.get('rsync', 'baseurl')
         self.target = file_config.get('images', 'target')
+        # Optional settings.
+        self.upload = None
+        if file_config.has_option('rsync', 'upload'):
+            self.upload = file_config.get('rsync', 'upload')
+        self.peers = []
+        if file_config.has_option('rsync', 'peers'):
+            self.peers = file_config.get('rsync', 'peers').split()
+        self.transport = 'rsync'
+        if file_config.has_option('rsync', 'transport'):
+            self.transport = file_config.get('rsync', 'transport')
+        self.partial_max_age = 7
+        if file_config.has_option('images', 'partial_max_age'):
+            self.partial_max_age = file_config.getint('images',
+                                                      'partial_max_age')
+        self.verify = True
+        if file_config.has_option('images', 'verify'):
+            self.verify = file_config.getboolean('images', 'verify')
+        self.templates = None
+        if file_config.has_option('images', 'templates'):
+            self.templates = file_config.get('images', 'templates')
+        self.budget = None
+        if file_config.has_option('images', 'budget'):
+            self.budget = parse_size(file_config.get('images', 'budget'))
+        self.pinned = []
+        if file_config.has_option('images', 'pinned'):
+            self.pinned = file_config.get('images', 'pinned').split()
+        self.catalog_ttl = 300
+        if file_config.has_option('rsync', 'catalog_ttl'):
+            self.catalog_ttl = file_config.getint('rsync', 'catalog_ttl')
+        self.jobs = 1
+        if file_config.has_option('rsync', 'jobs'):
+            self.jobs = file_config.getint('rsync', 'jobs')
+        self.bwlimit = None
+        if file_config.has_option('rsync', 'bwlimit'):
+            self.bwlimit = file_config.getint('rsync', 'bwlimit')
+        self.jitter = 0
+        if file_config.has_option('schedule', 'jitter'):
+            self.jitter = file_config.getint('schedule', 'jitter')
+        self.idle = False
+        if file_config.has_option('schedule', 'idle'):
+            self.idle = file_config.getboolean('schedule', 'idle')
+        self.background = False
+        if file_config.has_option('schedule', 'background'):
+            self.background = file_config.getboolean('schedule',
+                                                     'background')
+        self.backend = 'cli'
+        if file_config.has_option('virtualbox', 'backend'):
+            self.backend = file_config.get('virtualbox', 'backend')
+        self.logfile = '/var/log/vbox-sync.log'
+        if file_config.has_option('schedule', 'logfile'):
+            self.logfile = file_config.get('schedule', 'logfile')
 
     def _read_cmdline_options(self, options):
         if getattr(options, 'baseurl', None):
             self.baseurl = options.baseurl
         if getattr(options, 'target', None):
             self.target = options.target
+        if getattr(options, 'upload', None):
+            self.upload = options.upload
+        if getattr(options, 'transport', None):
+            self.transport = options.transport
+        if getattr(options, 'peers', None):
+            self.peers = options.peers
+        if getattr(options, 'jobs', None):
+            self.jobs = options.jobs
+        if getattr(options, 'budget', None):
+            self.budget = parse_size(options.budget)
+        if getattr(options, 'bwlimit', None):
+            self.bwlimit = options.bwlimit
+        if getattr(options, 'verify', None) is not None:
+            self.verify = options.verify
+        if getattr(options, 'jitter', None) is not None:
+            self.jitter = options.jitter
+        if getattr(options, 'idle', None):
+            self.idle = options.idle
+        if getattr(options, 'background', None) is not None:
+            self.background = options.background
 
 class OptionParser(optparse.OptionParser):
     """An almost-normal OptionParser object, with the difference that it
@@ -78,13 +78,24 @@ def bump_version_number(version):
     finally:
         os.remove(tmp)
 
-def dialogued_action(text, action):
+def dialogued_action(text, action, progress=False):
+    """Runs action in a thread while showing a dialog with the text.  If
+    progress is true, action is passed a callback taking the amount of
+    work done and the total, which is shown as a percentage."""
     dlg = gtk.MessageDialog(flags = gtk.DIALOG_MODAL)
     dlg.props.text = text
-    
+
+    def show_progress(done, total):
+        if total:
+            gobject.idle_add(dlg.format_secondary_text,
+                             "%d%%" % (done * 100 // total))
+
     class Thread(threading.Thread):
         def run(self):
-            action()
+            if progress:
+                action(show_progress)
+            else:
+                action()
             dlg.destroy()
 
     thread = Thread()
@@ -180,9 +191,9 @@ class VBoxSyncAdminGui(object):
             self.image = model.get(iter,0)[0]
 
             dialogued_action( "Kopiere Orginal-Systemimage (Dies kann eine Weile dauern).",
-                               self.image.prepare_admin_mode )
+                               self.image.prepare_admin_mode, progress=True )
 
-            self.wTree.get_widget("packageentry").set_text(self.image.package_name)
+            self.wTree.get_widget("packageentry").set_text(self.image.package_name or '')
             self.wTree.get_widget("versionentry").set_text(bump_version_number(self.image.image_version))
             self.wTree.get_widget("distributionentry").set_text("UNRELEASED")
 
@@ -0,0 +1,313 @@
+# vim:set et sw=4 encoding=utf-8:
+#
+# Backends through which VBoxRegistry talks to VirtualBox
+#
+# Licensed under the EUPL, Version 1.0 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# you may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+#
+# http://ec.europa.eu/idabc/eupl
+#
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+
+"""Backends through which VBoxRegistry talks to VirtualBox.
+
+VirtualBox is reached through the VBoxManage command-line tool, through
+the VirtualBox Python API within the process or, for testing, replaced
+by a fake in memory.
+"""
+
+import logging
+import re
+import subprocess
+import uuid as uuidlib
+
+class VBoxInvocationError(Exception):
+    pass
+
+class VBoxBackendError(Exception):
+    """This exception is raised when a backend is not available."""
+    pass
+
+def guarded_vboxmanage_call(args):
+    cmdline = ['VBoxManage', '-nologo', '-convertSettingsBackup'] + args
+    retcode = subprocess.call(cmdline)
+    if retcode != 0:
+        raise VBoxInvocationError, ' '.join(cmdline)
+
+IDE_PORTS = ('hda', 'hdb', 'hdc', 'hdd')
+
+class VBoxManageBackend(object):
+    """Runs VBoxManage for every operation.  Every call is a new process
+    that connects to VBoxSVC and loads the registry."""
+
+    # Whether operations may be run from several threads at once.
+    concurrent = True
+    # Whether the VirtualBox settings files reflect the state of this
+    # backend, so that they can be read directly.
+    settings_files = True
+
+    def _output(self, args, check=False):
+        cmdline = ['VBoxManage', '-nologo', '-convertSettingsBackup'] + args
+        p = subprocess.Popen(cmdline, stdout=subprocess.PIPE)
+        output = p.communicate()[0]
+        if check and p.returncode != 0:
+            raise VBoxInvocationError, ' '.join(cmdline)
+        return output
+
+    def _get_list_value(self, line):
+        return line.split(' ', 1)[1].strip()
+
+    def list_vms(self):
+        """Returns a dict mapping the UUIDs of all VMs to their names."""
+        vms, current_name = {}, None
+        for line in self._output(['list', 'vms']).splitlines():
+            # XXX: test if this is locale dependent
+            if line.startswith('Name:'):
+                current_name = self._get_list_value(line)
+            elif line.startswith('UUID:'):
+                uuid = self._get_list_value(line)
+                vms[uuid] = current_name
+            else:
+                m = re.match(r'"(.*)" {(.*)}', line)
+                if m:
+                    vms[m.group(2)] = m.group(1)
+        return vms
+
+    def list_hdds(self):
+        """Returns a dict mapping the UUIDs of all hard disks to their
+        locations."""
+        hdds, current_uuid = {}, None
+        for line in self._output(['list', 'hdds']).splitlines():
+            if line.startswith('UUID:'):
+                current_uuid = self._get_list_value(line)
+            elif line.startswith('Location:'):
+                # Fall back to the location as the key in case the output
+                # did not list the UUID first.
+                location = self._get_list_value(line)
+                hdds[current_uuid or location] = location
+                current_uuid = None
+        return hdds
+
+    def create_vm(self, name):
+        """Creates and registers a VM and returns its UUID."""
+        output = self._output(['createvm', '-name', name, '-register'])
+        for line in output.splitlines():
+            if line.startswith('UUID:'):
+                return self._get_list_value(line)
+        raise VBoxInvocationError, 'createvm %s failed' % name
+
+    def show_vm_info(self, identifier):
+        """Returns the output of showvminfo -machinereadable."""
+        return self._output(['showvminfo', identifier, '-machinereadable'],
+                            check=True)
+
+    def modify_vm(self, identifier, parameters):
+        """Takes a dict of modifyvm parameters (with leading dashes)."""
+        arg_list = []
+        for key in parameters:
+            arg_list.extend([key, str(parameters[key])])
+        guarded_vboxmanage_call(['modifyvm', identifier] + arg_list)
+
+    def open_hdd(self, location, disk_type):
+        guarded_vboxmanage_call(['openmedium', 'disk', location,
+                                 '-type', disk_type])
+
+    def close_hdd(self, identifier):
+        guarded_vboxmanage_call(['closemedium', 'disk', identifier])
+
+    def is_hdd_in_use(self, location):
+        output = self._output(['showhdinfo', location])
+        return re.search(r'In use by VMs:', output) is not None
+
+class VBoxAPIBackend(VBoxManageBackend):
+    """Uses the VirtualBox Python API (vboxapi) through one connection
+    kept for the lifetime of the backend.  Queries and the closing of
+    hard disks are done through the API; everything else, and every
+    query the API fails on, still goes through VBoxManage.  As the
+    operations of a launch are not covered yet, this is not the default
+    backend."""
+
+    # The API connection must not be shared between threads.
+    concurrent = False
+
+    def __init__(self):
+        try:
+            from vboxapi import VirtualBoxManager
+        except ImportError:
+            raise VBoxBackendError, 'vboxapi not available'
+        try:
+            self.manager = VirtualBoxManager(None, None)
+            self.vbox = self.manager.vbox
+        except Exception, e:
+            raise VBoxBackendError, 'cannot connect to VirtualBox: %s' % e
+        self.logger = logging.getLogger('itomig.vbox')
+
+    def _array(self, obj, attribute):
+        return self.manager.getArray(obj, attribute)
+
+    def _call(self, method, fallback, *args):
+        """Calls method and fallback (the VBoxManage implementation) if
+        the API call fails."""
+        try:
+            return method(*args)
+        except Exception, e:
+            self.logger.debug('VirtualBox API call failed, falling back '
+                              'to VBoxManage: %s', e)
+            return fallback(self, *args)
+
+    def _all_hdds(self):
+        """Yields all hard disks, children after their parents."""
+        pending = list(self._array(self.vbox, 'hardDisks'))
+        while pending:
+            hdd = pending.pop(0)
+            yield hdd
+            pending.extend(self._array(hdd, 'children'))
+
+    def _find_hdd(self, identifier):
+        for hdd in self._all_hdds():
+            if identifier in (hdd.id.strip('{}'), hdd.location):
+                return hdd
+        raise VBoxInvocationError, 'unknown hard disk %s' % identifier
+
+    def _list_vms(self):
+        vms = {}
+        for machine in self._array(self.vbox, 'machines'):
+            vms[machine.id.strip('{}')] = machine.name
+        return vms
+
+    def list_vms(self):
+        return self._call(self._list_vms, VBoxManageBackend.list_vms)
+
+    def _list_hdds(self):
+        hdds = {}
+        for hdd in self._all_hdds():
+            hdds[hdd.id.strip('{}')] = hdd.location
+        return hdds
+
+    def list_hdds(self):
+        return self._call(self._list_hdds, VBoxManageBackend.list_hdds)
+
+    def _close_hdd(self, identifier):
+        self._find_hdd(identifier).close()
+
+    def close_hdd(self, identifier):
+        self._call(self._close_hdd, VBoxManageBackend.close_hdd, identifier)
+
+    def _is_hdd_in_use(self, location):
+        return len(self._array(self._find_hdd(location), 'machineIds')) > 0
+
+    def is_hdd_in_use(self, location):
+        return self._call(self._is_hdd_in_use,
+                          VBoxManageBackend.is_hdd_in_use, location)
+
+class FakeVBoxBackend(object):
+    """An in-memory stand-in for VirtualBox, to exercise and measure the
+    registry logic on machines without VirtualBox.  Every operation is
+    recorded in calls."""
+
+    concurrent = True
+    settings_files = False
+
+    def __init__(self):
+        # VM UUID to name and dict of settings (without leading dashes),
+        # hard disk UUID to location and type.
+        self.vms = {}
+        self.hdds = {}
+        self.calls = []
+
+    def _find_vm(self, identifier):
+        for uuid, (name, settings) in self.vms.items():
+            if identifier in (uuid, name):
+                return uuid
+        raise VBoxInvocationError, 'unknown VM %s' % identifier
+
+    def _find_hdd(self, identifier):
+        for uuid, (location, disk_type) in self.hdds.items():
+            if identifier in (uuid, location):
+                return uuid
+        raise VBoxInvocationError, 'unknown hard disk %s' % identifier
+
+    def list_vms(self):
+        self.calls.append(('list_vms',))
+        vms = {}
+        for uuid, (name, settings) in self.vms.items():
+            vms[uuid] = name
+        return vms
+
+    def list_hdds(self):
+        self.calls.append(('list_hdds',))
+        hdds = {}
+        for uuid, (location, disk_type) in self.hdds.items():
+            hdds[uuid] = location
+        return hdds
+
+    def create_vm(self, name):
+        self.calls.append(('create_vm', name))
+        uuid = str(uuidlib.uuid4())
+        self.vms[uuid] = (name, {})
+        return uuid
+
+    def show_vm_info(self, identifier):
+        self.calls.append(('show_vm_info', identifier))
+        uuid = self._find_vm(identifier)
+        name, settings = self.vms[uuid]
+        lines = ['name="%s"' % name, 'UUID="%s"' % uuid]
+        for key in IDE_PORTS:
+            lines.append('%s="%s"' % (key, settings.get(key, 'none')))
+        for key, value in settings.items():
+            if key not in IDE_PORTS:
+                lines.append('%s="%s"' % (key, value))
+        return '\n'.join(lines) + '\n'
+
+    def modify_vm(self, identifier, parameters):
+        self.calls.append(('modify_vm', identifier, dict(parameters)))
+        settings = self.vms[self._find_vm(identifier)][1]
+        for key, value in parameters.items():
+            settings[key.lstrip('-')] = str(value)
+
+    def open_hdd(self, location, disk_type):
+        self.calls.append(('open_hdd', location, disk_type))
+        for uuid, (other, other_type) in self.hdds.items():
+            if other == location:
+                raise VBoxInvocationError, '%s already registered' % location
+        self.hdds[str(uuidlib.uuid4())] = (location, disk_type)
+
+    def close_hdd(self, identifier):
+        self.calls.append(('close_hdd', identifier))
+        del self.hdds[self._find_hdd(identifier)]
+
+    def is_hdd_in_use(self, location):
+        self.calls.append(('is_hdd_in_use', location))
+        for name, settings in self.vms.values():
+            for key in IDE_PORTS:
+                if settings.get(key) == location:
+                    return True
+        return False
+
+BACKENDS = ('auto', 'cli', 'api', 'fake')
+
+def create_backend(name='cli'):
+    """Returns the named backend.  auto uses the API if it is available and
+    VBoxManage otherwise."""
+    if name == 'cli':
+        return VBoxManageBackend()
+    elif name == 'api':
+        return VBoxAPIBackend()
+    elif name == 'fake':
+        return FakeVBoxBackend()
+    elif name == 'auto':
+        try:
+            return VBoxAPIBackend()
+        except VBoxBackendError:
+            return VBoxManageBackend()
+    raise ValueError, 'unknown VirtualBox backend %s' % name
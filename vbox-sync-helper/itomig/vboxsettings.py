@@ -0,0 +1,246 @@
+# vim:set et sw=4 encoding=utf-8:
+#
+# Read-only access to the VirtualBox settings files
+#
+# Licensed under the EUPL, Version 1.0 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# you may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+#
+# http://ec.europa.eu/idabc/eupl
+#
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+
+"""Read-only access to the VirtualBox registry in its settings files.
+
+The settings files in VBOX_USER_HOME are VirtualBox.xml with the machine
+and media registry and the settings file of every machine.  All changes
+still go through VBoxManage.
+"""
+
+import os
+import os.path
+
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    try:
+        from xml.etree import ElementTree
+    except ImportError:
+        try:
+            from elementtree import ElementTree
+        except ImportError:
+            ElementTree = None
+
+GLOBAL_SETTINGS_FILE = 'VirtualBox.xml'
+
+# IDE ports by (channel, device), as named by VBoxManage modifyvm.
+IDE_PORTS = {
+    (0, 0): 'hda',
+    (0, 1): 'hdb',
+    (1, 0): 'hdc',
+    (1, 1): 'hdd',
+    }
+
+class VBoxSettingsError(Exception):
+    """This exception is raised when the settings files cannot be read or
+    are not understood.  Callers should fall back to VBoxManage then."""
+    pass
+
+def _tag(element):
+    """Returns the tag of the element without its XML namespace."""
+    return element.tag.split('}', 1)[-1]
+
+def _children(element, tag):
+    return [child for child in element if _tag(child) == tag]
+
+def _descendants(element, tag):
+    return [child for child in element.getiterator() if _tag(child) == tag]
+
+def _uuid(value):
+    """The settings files put UUIDs into braces, VBoxManage does not."""
+    return value.strip('{}')
+
+class VBoxSettingsReader(object):
+    """Reads VMs, hard disks, their parentage and the attachments of the
+    VMs from the settings files in the given VirtualBox home directory.
+    The files are parsed on first use and kept until invalidate() is
+    called."""
+
+    def __init__(self, vbox_home):
+        self.vbox_home = vbox_home
+        self.invalidate()
+
+    def invalidate(self):
+        # VM UUID to (name, settings file), hard disk UUID to location and
+        # hard disk UUID to the UUID of its parent.
+        self._vms = None
+        self._hdds = None
+        self._parents = None
+        # VM UUID to the dict of IDE ports to hard disk UUIDs and to the
+        # set of all hard disk UUIDs referenced, including snapshots.
+        self._attachments = None
+        self._references = None
+
+    def _parse(self, filename):
+        try:
+            return ElementTree.parse(filename).getroot()
+        except (IOError, SyntaxError), e:
+            # Older ElementTree versions raise SyntaxError subclasses for
+            # malformed files.
+            raise VBoxSettingsError, '%s: %s' % (filename, e)
+
+    def _location(self, location):
+        """Relative locations are relative to the VirtualBox home."""
+        return os.path.normpath(os.path.join(self.vbox_home, location))
+
+    def _load(self):
+        if self._vms is not None:
+            return
+        if ElementTree is None:
+            raise VBoxSettingsError, 'no ElementTree implementation available'
+        if not self.vbox_home:
+            raise VBoxSettingsError, 'VirtualBox home directory unknown'
+        filename = os.path.join(self.vbox_home, GLOBAL_SETTINGS_FILE)
+        if not os.path.exists(filename):
+            raise VBoxSettingsError, '%s does not exist' % filename
+        root = self._parse(filename)
+        vms, hdds, parents = {}, {}, {}
+        for entry in _descendants(root, 'MachineEntry'):
+            vms[_uuid(entry.get('uuid'))] = \
+                (None, self._location(entry.get('src')))
+        for registry in _descendants(root, 'HardDisks'):
+            self._load_hdds(registry, None, hdds, parents)
+        attachments, references = {}, {}
+        for uuid, (name, settings_file) in vms.items():
+            machine_root = self._parse(settings_file)
+            machines = _descendants(machine_root, 'Machine')
+            if not machines:
+                raise VBoxSettingsError, '%s: no machine found' % settings_file
+            machine = machines[0]
+            vms[uuid] = (machine.get('name'), settings_file)
+            attachments[uuid] = self._machine_attachments(machine)
+            references[uuid] = set()
+            for element in _descendants(machine, 'HardDiskAttachment'):
+                references[uuid].add(_uuid(element.get('hardDisk')))
+            for element in _descendants(machine, 'AttachedDevice'):
+                for image in _children(element, 'Image'):
+                    references[uuid].add(_uuid(image.get('uuid')))
+        (self._vms, self._hdds, self._parents, self._attachments,
+         self._references) = (vms, hdds, parents, attachments, references)
+
+    def _load_hdds(self, element, parent, hdds, parents):
+        """Differencing disks are nested within their parents."""
+        for hdd in _children(element, 'HardDisk'):
+            uuid = _uuid(hdd.get('uuid'))
+            hdds[uuid] = self._location(hdd.get('location'))
+            if parent:
+                parents[uuid] = parent
+            self._load_hdds(hdd, uuid, hdds, parents)
+
+    def _machine_attachments(self, machine):
+        """Returns the hard disks attached to the IDE ports of the current
+        state of the machine (not of its snapshots)."""
+        attachments = {}
+        # VirtualBox 2.x lists the attachments directly.
+        for container in _children(machine, 'HardDiskAttachments'):
+            for element in _children(container, 'HardDiskAttachment'):
+                if element.get('bus', 'IDE') != 'IDE':
+                    continue
+                port = IDE_PORTS.get((int(element.get('channel', 0)),
+                                      int(element.get('device', 0))))
+                if port:
+                    attachments[port] = _uuid(element.get('hardDisk'))
+        # Later versions attach devices to storage controllers, which
+        # moved into the hardware section over time.  Snapshots have their
+        # own sections further down, those are not looked at.
+        containers = _children(machine, 'StorageControllers')
+        for hardware in _children(machine, 'Hardware'):
+            containers.extend(_children(hardware, 'StorageControllers'))
+        for controllers in containers:
+            for controller in _children(controllers, 'StorageController'):
+                if controller.get('type') not in ('PIIX3', 'PIIX4', 'ICH6'):
+                    continue
+                for device in _children(controller, 'AttachedDevice'):
+                    if device.get('type') != 'HardDisk':
+                        continue
+                    port = IDE_PORTS.get((int(device.get('port', 0)),
+                                          int(device.get('device', 0))))
+                    images = _children(device, 'Image')
+                    if port and images:
+                        attachments[port] = _uuid(images[0].get('uuid'))
+        return attachments
+
+    def get_vms(self):
+        """Returns a dict mapping VM UUIDs to their names."""
+        self._load()
+        vms = {}
+        for uuid, (name, settings_file) in self._vms.items():
+            vms[uuid] = name
+        return vms
+
+    def get_hdds(self):
+        """Returns a dict mapping hard disk UUIDs to their locations."""
+        self._load()
+        return dict(self._hdds)
+
+    def get_parent(self, uuid):
+        """Returns the UUID of the parent of a differencing disk or None."""
+        self._load()
+        return self._parents.get(uuid)
+
+    def _find_vm(self, identifier):
+        for uuid, (name, settings_file) in self._vms.items():
+            if identifier in (uuid, name):
+                return uuid
+        raise VBoxSettingsError, 'unknown VM %s' % identifier
+
+    def get_attached_hdds(self, identifier):
+        """Returns a dict mapping the IDE ports of the VM (given by name or
+        UUID) to the locations of the hard disks attached to them."""
+        self._load()
+        attached = {}
+        for port, uuid in self._attachments[self._find_vm(identifier)].items():
+            if uuid not in self._hdds:
+                raise VBoxSettingsError, 'unknown hard disk %s' % uuid
+            attached[port] = self._hdds[uuid]
+        return attached
+
+    def get_hdds_in_use(self):
+        """Returns the set of UUIDs of all hard disks attached to any VM,
+        in its current state or in one of its snapshots, together with
+        all their parents."""
+        self._load()
+        in_use = set()
+        for references in self._references.values():
+            for uuid in references:
+                while uuid and uuid not in in_use:
+                    in_use.add(uuid)
+                    uuid = self._parents.get(uuid)
+        return in_use
+
+    def get_depth(self, uuid):
+        """Returns the number of parents of the hard disk."""
+        self._load()
+        depth = 0
+        while uuid in self._parents:
+            uuid = self._parents[uuid]
+            depth += 1
+        return depth
+
+    def is_hdd_in_use(self, uuid):
+        """Tells whether the hard disk is attached to any VM, either in its
+        current state or in one of its snapshots."""
+        self._load()
+        for references in self._references.values():
+            if uuid in references:
+                return True
+        return False
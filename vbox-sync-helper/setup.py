@@ -8,8 +8,10 @@ setup(name='vbox-sync-helper',
         'Programming Language :: Python'
         ],
       packages=['itomig'],
-      scripts=['vbox-sync', 'vbox-invoke', 'vbox-makecfg', 'vbox-dispose', 'vbox-sync-admin'],
-      data_files=[('share/man/man1', ['vbox-invoke.1', 'vbox-makecfg.1', 'vbox-sync-admin.1']),
+      scripts=['vbox-sync', 'vbox-invoke', 'vbox-makecfg', 'vbox-dispose', 'vbox-sync-admin',
+               'vbox-publish'],
+      data_files=[('share/man/man1', ['vbox-invoke.1', 'vbox-makecfg.1', 'vbox-sync-admin.1',
+                                     'vbox-publish.1']),
                   ('share/man/man8', ['vbox-sync.8', 'vbox-dispose.8'])],
       package_data={'itomig': ['vbox-sync-admin.glade']},
      )
@@ -0,0 +1,226 @@
+# vim:set et sw=4 encoding=utf-8:
+#
+# Stand-ins for the tools called by vbox-sync and vbox-invoke
+#
+# Licensed under the EUPL, Version 1.0 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# you may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+#
+# http://ec.europa.eu/idabc/eupl
+#
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+
+"""
+Scripts that stand in for VBoxManage, rsync, dpkg-query, parted and ionice
+on machines without them.  They are configured through BENCH_* variables
+in the environment; benchmarks/run-benchmarks puts them on the PATH.
+"""
+
+import os
+import os.path
+import sys
+
+# Every stand-in starts by recording its call and sleeping.
+STANDIN_HEADER = '''#!%(python)s
+import os, sys, time
+try:
+    import json
+except ImportError:
+    import simplejson as json
+name = os.path.basename(sys.argv[0])
+f = open(os.environ['BENCH_LOG'], 'a')
+f.write(json.dumps({'exe': name, 'args': sys.argv[1:],
+                    'phase': os.environ.get('BENCH_PHASE', 'other')}) + '\\n')
+f.close()
+time.sleep(float(os.environ.get('BENCH_DELAY_' +
+                                name.upper().replace('-', '_'), '0')))
+'''
+
+STANDINS = {}
+
+STANDINS['VBoxManage'] = '''
+# Keeps the registry in a JSON file and writes minimal settings files to
+# VBOX_USER_HOME, so that vbox-invoke reads them like the real ones.
+import uuid
+from xml.sax.saxutils import quoteattr
+path = os.environ['BENCH_VBOX_STATE']
+try:
+    state = json.load(open(path))
+except (IOError, ValueError):
+    state = {'vms': {}, 'hdds': {}}
+PORTS = {'hda': (0, 0), 'hdb': (0, 1), 'hdc': (1, 0), 'hdd': (1, 1)}
+def write(filename, lines):
+    f = open(filename + '.tmp', 'w')
+    f.write('<?xml version="1.0"?>\\n<VirtualBox>\\n%s\\n</VirtualBox>\\n' %
+            '\\n'.join(lines))
+    f.close()
+    os.rename(filename + '.tmp', filename)
+def write_settings():
+    home = os.environ['VBOX_USER_HOME']
+    lines = ['<Global><MachineRegistry>']
+    for vm_uuid, vm in state['vms'].items():
+        directory = os.path.join(home, 'Machines', vm['name'])
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        machine_file = os.path.join(directory, vm['name'] + '.xml')
+        lines.append('<MachineEntry uuid="{%s}" src=%s/>' %
+                     (vm_uuid, quoteattr(machine_file)))
+        attachments = []
+        for port, (channel, device) in PORTS.items():
+            for hdd_uuid, hdd in state['hdds'].items():
+                if hdd['location'] == vm['settings'].get(port):
+                    attachments.append(
+                        '<HardDiskAttachment hardDisk="{%s}" bus="IDE" '
+                        'channel="%d" device="%d"/>' %
+                        (hdd_uuid, channel, device))
+        write(machine_file, ['<Machine uuid="{%s}" name=%s>' %
+                             (vm_uuid, quoteattr(vm['name'])),
+                             '<HardDiskAttachments>'] + attachments +
+                            ['</HardDiskAttachments>', '</Machine>'])
+    lines.append('</MachineRegistry><MediaRegistry><HardDisks>')
+    for hdd_uuid, hdd in state['hdds'].items():
+        lines.append('<HardDisk uuid="{%s}" location=%s type="%s"/>' %
+                     (hdd_uuid, quoteattr(hdd['location']), hdd['type']))
+    lines.append('</HardDisks></MediaRegistry></Global>')
+    write(os.path.join(home, 'VirtualBox.xml'), lines)
+def save():
+    json.dump(state, open(path, 'w'))
+    write_settings()
+def find_vm(identifier):
+    for vm_uuid, vm in state['vms'].items():
+        if identifier in (vm_uuid, vm['name']):
+            return vm_uuid, vm
+    sys.exit(1)
+args = [a for a in sys.argv[1:] if a not in ('-nologo',
+                                             '-convertSettingsBackup')]
+command = args[0]
+if command == 'list' and args[1] == 'vms':
+    for vm_uuid, vm in state['vms'].items():
+        print '"%s" {%s}' % (vm['name'], vm_uuid)
+elif command == 'list' and args[1] == 'hdds':
+    for hdd_uuid, hdd in state['hdds'].items():
+        print 'UUID:        %s' % hdd_uuid
+        print 'Location:    %s' % hdd['location']
+        print
+elif command == 'createvm':
+    vm_uuid = str(uuid.uuid4())
+    state['vms'][vm_uuid] = {'name': args[args.index('-name') + 1],
+                             'settings': {}}
+    save()
+    print 'UUID: %s' % vm_uuid
+elif command == 'modifyvm':
+    vm_uuid, vm = find_vm(args[1])
+    for key, value in zip(args[2::2], args[3::2]):
+        vm['settings'][key.lstrip('-')] = value
+    save()
+elif command == 'showvminfo':
+    vm_uuid, vm = find_vm(args[1])
+    print 'name="%s"' % vm['name']
+    print 'UUID="%s"' % vm_uuid
+    for key, value in vm['settings'].items():
+        print '%s="%s"' % (key, value)
+elif command == 'openmedium':
+    for hdd in state['hdds'].values():
+        if hdd['location'] == args[2]:
+            sys.exit(1)
+    state['hdds'][str(uuid.uuid4())] = {'location': args[2],
+                                        'type': args[args.index('-type') + 1]}
+    save()
+elif command == 'closemedium':
+    for hdd_uuid, hdd in state['hdds'].items():
+        if args[2] in (hdd_uuid, hdd['location']):
+            del state['hdds'][hdd_uuid]
+    save()
+elif command in ('showhdinfo', 'startvm', 'convertfromraw'):
+    pass
+else:
+    sys.exit(2)
+'''
+
+STANDINS['rsync'] = '''
+# Copies from the local directory the rsync:// URL is mapped to.
+import shutil
+options = [a for a in sys.argv[1:] if a.startswith('-')]
+paths = [a.replace(os.environ['BENCH_RSYNC_URL'],
+                   os.environ['BENCH_RSYNC_ROOT'], 1)
+         for a in sys.argv[1:] if not a.startswith('-')]
+if '--list-only' in options:
+    # Lists the files of the image versions, like --exclude=/*/*/*/ would.
+    root = paths[-1].rstrip('/')
+    for directory, subdirectories, filenames in os.walk(root):
+        path = directory[len(root):].strip('/')
+        if path.count('/') == 1 and not path.startswith('chunks/'):
+            for filename in filenames:
+                print '-rw-r--r-- %14d 2009/05/01 12:00:00 %s/%s' % \
+                      (os.path.getsize(os.path.join(directory, filename)),
+                       path, filename)
+    sys.exit(0)
+source, destination = paths[-2:]
+if '--files-from=-' not in options:
+    shutil.copy(source, destination)
+    sys.exit(0)
+status, literal = 0, 0
+for filename in sys.stdin.read().split():
+    src = os.path.join(source, filename)
+    dst = os.path.join(destination, filename)
+    if not os.path.exists(src):
+        sys.stderr.write('rsync: link_stat "%s" (in bench) failed: '
+                         'No such file or directory (2)\\n' % filename)
+        status = 23
+        continue
+    if not os.path.isdir(os.path.dirname(dst)):
+        os.makedirs(os.path.dirname(dst))
+    if '--ignore-times' not in options and os.path.exists(dst) and \\
+       os.path.getsize(src) == os.path.getsize(dst) and \\
+       int(os.path.getmtime(src)) == int(os.path.getmtime(dst)):
+        continue
+    shutil.copy2(src, dst)
+    literal += os.path.getsize(src)
+print 'Literal data: %d bytes' % literal
+print 'Matched data: 0 bytes'
+sys.exit(status)
+'''
+
+STANDINS['dpkg-query'] = '''
+# Reports every package as installed in BENCH_PACKAGE_VERSION.
+args = sys.argv[1:]
+form = '${Version}'
+for option in ('--showformat', '-f'):
+    if option in args:
+        form = args[args.index(option) + 1]
+        del args[args.index(option):args.index(option) + 2]
+packages = [a for a in args if not a.startswith('-')] or \\
+           os.environ.get('BENCH_PACKAGES', '').split()
+for package in packages:
+    sys.stdout.write(form.replace('${Package}', package)
+                         .replace('${Version}',
+                                  os.environ.get('BENCH_PACKAGE_VERSION', '1'))
+                         .replace('${Status}', 'install ok installed')
+                         .replace('\\\\t', '\\t')
+                         .replace('\\\\n', '\\n'))
+'''
+
+STANDINS['parted'] = ''
+STANDINS['ionice'] = ''
+
+def write_standins(directory):
+    """Writes all stand-ins as executables into the directory, which is
+    created."""
+    os.makedirs(directory)
+    for name, body in STANDINS.items():
+        filename = os.path.join(directory, name)
+        f = open(filename, 'w')
+        try:
+            f.write(STANDIN_HEADER % {'python': sys.executable} + body)
+        finally:
+            f.close()
+        os.chmod(filename, 0755)
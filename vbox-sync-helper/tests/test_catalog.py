@@ -0,0 +1,121 @@
+# vim:set et sw=4 encoding=utf-8:
+#
+# Tests for the catalog of installed images in itomig.catalog
+#
+# Licensed under the EUPL, Version 1.0 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# you may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+#
+# http://ec.europa.eu/idabc/eupl
+#
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+
+"""
+Records syncs and uses of images in a catalog in a temporary directory.
+"""
+
+import os.path
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from itomig.catalog import ImageCatalog, catalog_path, sqlite3
+
+class ImageCatalogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.catalog = ImageCatalog(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_no_catalog(self):
+        self.assertEqual(self.catalog.images(), {})
+        self.assertEqual(self.catalog.get('foo'), None)
+        # Reading does not create the catalog.
+        self.failIf(os.path.exists(catalog_path(self.directory)))
+
+    def test_record_sync(self):
+        before = time.time()
+        self.catalog.record_sync('foo', '1.0', 1024, 'abc')
+        entry = self.catalog.get('foo')
+        self.assertEqual(entry['name'], 'foo')
+        self.assertEqual(entry['version'], '1.0')
+        self.assertEqual(entry['size'], 1024)
+        self.assertEqual(entry['checksum'], 'abc')
+        self.assert_(entry['synced'] >= before)
+        self.assertEqual(entry['last_used'], None)
+        self.assertEqual(entry['uses'], 0)
+        # Byte strings, like everywhere else.
+        self.assert_(isinstance(entry['version'], str))
+
+    def test_record_use_before_sync(self):
+        # Images installed before the catalog existed.
+        self.catalog.record_use('foo', '1.0')
+        entry = self.catalog.get('foo')
+        self.assertEqual(entry['version'], '1.0')
+        self.assertEqual(entry['uses'], 1)
+        self.assertEqual(entry['synced'], None)
+        self.assertNotEqual(entry['last_used'], None)
+
+    def test_usage_kept_across_versions(self):
+        self.catalog.record_sync('foo', '1.0', 1024)
+        self.catalog.record_use('foo', '1.0')
+        self.catalog.record_use('foo', '1.0')
+        last_used = self.catalog.get('foo')['last_used']
+        self.catalog.record_sync('foo', '2.0', 2048, 'def')
+        entry = self.catalog.get('foo')
+        self.assertEqual(entry['version'], '2.0')
+        self.assertEqual(entry['size'], 2048)
+        self.assertEqual(entry['uses'], 2)
+        self.assertEqual(entry['last_used'], last_used)
+
+    def test_several_images(self):
+        self.catalog.record_sync('foo', '1.0', 1024)
+        self.catalog.record_sync('bar', '2.0', 2048)
+        images = self.catalog.images()
+        self.assertEqual(sorted(images.keys()), ['bar', 'foo'])
+        self.assertEqual(images['bar']['version'], '2.0')
+
+    def test_remove(self):
+        self.catalog.record_sync('foo', '1.0', 1024)
+        self.catalog.remove('foo')
+        self.assertEqual(self.catalog.images(), {})
+
+    def test_waits_for_other_writers(self):
+        self.catalog.record_sync('foo', '1.0', 1024)
+        # Another process in the middle of a write transaction.
+        connection = sqlite3.connect(catalog_path(self.directory),
+                                     isolation_level=None,
+                                     check_same_thread=False)
+        connection.execute('BEGIN IMMEDIATE')
+        connection.execute('UPDATE images SET uses = 10')
+
+        def commit():
+            time.sleep(0.2)
+            connection.execute('COMMIT')
+            connection.close()
+
+        thread = threading.Thread(target=commit)
+        thread.start()
+        try:
+            self.catalog.record_use('foo', '1.0')
+        finally:
+            thread.join()
+        # The update of the other writer is not lost.
+        self.assertEqual(self.catalog.get('foo')['uses'], 11)
+
+if __name__ == '__main__':
+    unittest.main()
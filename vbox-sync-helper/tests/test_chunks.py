@@ -0,0 +1,239 @@
+# vim:set et sw=4 encoding=utf-8:
+#
+# Tests for the chunk manifests and the chunk store of itomig.chunks
+#
+# Licensed under the EUPL, Version 1.0 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# you may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+#
+# http://ec.europa.eu/idabc/eupl
+#
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+
+"""
+Builds manifests of small files, writes and reads them and reassembles
+the files from the chunk store and from other files.
+"""
+
+import hashlib
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from itomig.chunks import ChunkManifest, ChunkManifestError, ChunkStore, \
+    ChunkAssembler
+
+CHUNK_SIZE = 4096
+
+class ChunkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def write(self, name, data):
+        f = open(self.path(name), 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        return self.path(name)
+
+    def read(self, name):
+        f = open(self.path(name), 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def data(self):
+        """Two chunks of data, a zero chunk and a partial last chunk."""
+        return 'a' * CHUNK_SIZE + 'b' * CHUNK_SIZE + '\0' * CHUNK_SIZE + \
+               'c' * 100
+
+class ManifestTest(ChunkTestCase):
+
+    def test_from_file(self):
+        filename = self.write('image.vdi', self.data())
+        manifest = ChunkManifest.from_file(filename, CHUNK_SIZE)
+        self.assertEqual(manifest.size, 3 * CHUNK_SIZE + 100)
+        self.assertEqual(manifest.chunk_size, CHUNK_SIZE)
+        self.assertEqual(manifest.digests,
+                         [hashlib.sha256('a' * CHUNK_SIZE).hexdigest(),
+                          hashlib.sha256('b' * CHUNK_SIZE).hexdigest(),
+                          hashlib.sha256('\0' * CHUNK_SIZE).hexdigest(),
+                          hashlib.sha256('c' * 100).hexdigest()])
+        self.assertEqual([(offset, length) for (offset, length, digest)
+                          in manifest.chunks()],
+                         [(0, CHUNK_SIZE), (CHUNK_SIZE, CHUNK_SIZE),
+                          (2 * CHUNK_SIZE, CHUNK_SIZE),
+                          (3 * CHUNK_SIZE, 100)])
+
+    def test_empty_file(self):
+        manifest = ChunkManifest.from_file(self.write('empty', ''),
+                                           CHUNK_SIZE)
+        self.assertEqual(manifest.size, 0)
+        self.assertEqual(manifest.digests, [])
+
+    def test_zero_chunks(self):
+        manifest = ChunkManifest.from_file(self.write('image.vdi',
+                                                      self.data()),
+                                           CHUNK_SIZE)
+        self.assertEqual([manifest.is_zero(length, digest)
+                          for (offset, length, digest) in manifest.chunks()],
+                         [False, False, True, False])
+
+    def test_write_and_read(self):
+        manifest = ChunkManifest.from_file(self.write('image.vdi',
+                                                      self.data()),
+                                           CHUNK_SIZE)
+        manifest.write(self.path('image.vdi.chunks'))
+        read = ChunkManifest.read(self.path('image.vdi.chunks'))
+        self.assertEqual(read.size, manifest.size)
+        self.assertEqual(read.chunk_size, manifest.chunk_size)
+        self.assertEqual(read.digests, manifest.digests)
+        self.assertEqual(read.digest(), manifest.digest())
+
+    def test_read_invalid(self):
+        self.write('bad.chunks', 'size 10\nchunksize 4096\nnonsense\n')
+        self.assertRaises(ChunkManifestError, ChunkManifest.read,
+                          self.path('bad.chunks'))
+
+    def test_read_incomplete(self):
+        self.write('short.chunks', 'size 8192\nchunksize 4096\n%s\n' %
+                   hashlib.sha256('a' * CHUNK_SIZE).hexdigest())
+        self.assertRaises(ChunkManifestError, ChunkManifest.read,
+                          self.path('short.chunks'))
+
+class MatchesTest(ChunkTestCase):
+
+    def setUp(self):
+        ChunkTestCase.setUp(self)
+        # Enough chunks to give every thread several of them.
+        self.content = ''.join([chr(i) * CHUNK_SIZE for i in range(16)]) + \
+                       'end'
+        self.filename = self.write('image.vdi', self.content)
+        self.manifest = ChunkManifest.from_file(self.filename, CHUNK_SIZE)
+
+    def test_matches(self):
+        for jobs in (1, 3, 4, 100):
+            self.assertEqual(self.manifest.matches(self.filename, jobs),
+                             True)
+        self.assertEqual(self.manifest.matches(self.filename), True)
+
+    def test_changed_chunk(self):
+        for index in (0, 7, 16):
+            data = self.content[:index * CHUNK_SIZE] + 'x' + \
+                   self.content[index * CHUNK_SIZE + 1:]
+            self.write('changed.vdi', data)
+            for jobs in (1, 4):
+                self.assertEqual(self.manifest.matches(
+                                     self.path('changed.vdi'), jobs), False)
+
+    def test_size_differs(self):
+        self.write('longer.vdi', self.content + 'x')
+        self.assertEqual(self.manifest.matches(self.path('longer.vdi')),
+                         False)
+
+    def test_missing_file(self):
+        self.assertEqual(self.manifest.matches(self.path('missing.vdi')),
+                         False)
+
+    def test_empty_file(self):
+        filename = self.write('empty.vdi', '')
+        manifest = ChunkManifest.from_file(filename, CHUNK_SIZE)
+        self.assertEqual(manifest.matches(filename), True)
+
+class StoreTest(ChunkTestCase):
+
+    def setUp(self):
+        ChunkTestCase.setUp(self)
+        self.store = ChunkStore(self.path('chunks'))
+        self.manifest = ChunkManifest.from_file(
+            self.write('image.vdi', self.data()), CHUNK_SIZE)
+
+    def test_add_from_file(self):
+        self.assertEqual(self.store.add_from_file(self.path('image.vdi'),
+                                                  self.manifest), 3)
+        for offset, length, digest in self.manifest.chunks():
+            self.assertEqual(digest in self.store,
+                             not self.manifest.is_zero(length, digest))
+        # Nothing is added twice.
+        self.assertEqual(self.store.add_from_file(self.path('image.vdi'),
+                                                  self.manifest), 0)
+
+    def test_verify(self):
+        self.store.add_from_file(self.path('image.vdi'), self.manifest)
+        digest = self.manifest.digests[0]
+        self.assertEqual(self.store.verify(digest), True)
+        f = open(self.store.chunk_path(digest), 'ab')
+        try:
+            f.write('x')
+        finally:
+            f.close()
+        self.assertEqual(self.store.verify(digest), False)
+        self.failIf(digest in self.store)
+
+    def test_clear(self):
+        self.store.add_from_file(self.path('image.vdi'), self.manifest)
+        self.store.clear()
+        self.failIf(os.path.exists(self.path('chunks')))
+
+class AssemblerTest(ChunkTestCase):
+
+    def setUp(self):
+        ChunkTestCase.setUp(self)
+        self.store = ChunkStore(self.path('chunks'))
+
+    def test_assemble_from_store(self):
+        manifest = ChunkManifest.from_file(
+            self.write('image.vdi', self.data()), CHUNK_SIZE)
+        self.store.add_from_file(self.path('image.vdi'), manifest)
+        assembler = ChunkAssembler(self.store, [])
+        self.assertEqual(assembler.missing(manifest), set())
+        assembler.assemble(manifest, self.path('copy.vdi'))
+        self.assertEqual(self.read('copy.vdi'), self.data())
+
+    def test_assemble_from_installed_file(self):
+        old = self.write('old.vdi', 'b' * CHUNK_SIZE + 'a' * CHUNK_SIZE)
+        old_manifest = ChunkManifest.from_file(old, CHUNK_SIZE)
+        manifest = ChunkManifest.from_file(
+            self.write('image.vdi', self.data()), CHUNK_SIZE)
+        assembler = ChunkAssembler(self.store, [(old, old_manifest)])
+        # Only the last chunk is neither in the old file nor zero.
+        self.assertEqual(assembler.missing(manifest),
+                         set([manifest.digests[3]]))
+        self.assertRaises(ChunkManifestError, assembler.assemble, manifest,
+                          self.path('copy.vdi'))
+        ChunkStore(self.path('chunks')).add_from_file(
+            self.path('image.vdi'), manifest)
+        assembler.assemble(manifest, self.path('copy.vdi'))
+        self.assertEqual(self.read('copy.vdi'), self.data())
+
+    def test_assemble_does_not_write_through_links(self):
+        manifest = ChunkManifest.from_file(
+            self.write('image.vdi', self.data()), CHUNK_SIZE)
+        self.store.add_from_file(self.path('image.vdi'), manifest)
+        os.link(self.write('other.vdi', 'other'), self.path('copy.vdi'))
+        ChunkAssembler(self.store, []).assemble(manifest,
+                                                self.path('copy.vdi'))
+        self.assertEqual(self.read('other.vdi'), 'other')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,179 @@
+# vim:set et sw=4 encoding=utf-8:
+#
+# Tests for the data disk images written by itomig.datadisk
+#
+# Licensed under the EUPL, Version 1.0 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# you may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+#
+# http://ec.europa.eu/idabc/eupl
+#
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+
+"""
+Creates data disks of several sizes and checks the VDI header, the block
+map, the partition table and the boot sector of the filesystem.  Run with
+python -m unittest discover tests from the top directory.
+"""
+
+import os
+import os.path
+import shutil
+import struct
+import tempfile
+import unittest
+
+from itomig.datadisk import create_data_disk, DataDiskError, \
+    SECTOR_SIZE, PARTITION_START, PARTITION_TYPES, VDI_PRE_HEADER, \
+    VDI_SIGNATURE, VDI_VERSION, VDI_HEADER_SIZE, VDI_BLOCK_SIZE, \
+    VDI_BLOCK_FREE
+
+class VDIImage(object):
+    """Reads the sectors of the virtual disk through the block map."""
+
+    def __init__(self, filename):
+        f = open(filename, 'rb')
+        try:
+            self.data = f.read()
+        finally:
+            f.close()
+        (self.pre_header, self.signature, self.version, self.header_size,
+         self.image_type, self.flags, self.comment, self.blocks_offset,
+         self.data_offset) = struct.unpack('<64sIIIII256sII', self.data[:348])
+        (self.disk_size, self.block_size, self.block_extra, self.block_count,
+         self.blocks_allocated) = struct.unpack('<QIIII',
+                                                self.data[368:392])
+        self.block_map = struct.unpack('<%dI' % self.block_count,
+            self.data[self.blocks_offset:
+                      self.blocks_offset + 4 * self.block_count])
+
+    def sector(self, number):
+        index, offset = divmod(number * SECTOR_SIZE, self.block_size)
+        position = self.block_map[index]
+        if position == VDI_BLOCK_FREE:
+            return '\0' * SECTOR_SIZE
+        start = self.data_offset + position * self.block_size + offset
+        return self.data[start:start + SECTOR_SIZE]
+
+class DataDiskTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def create(self, size, fs_type=None):
+        filename = os.path.join(self.directory, 'data-%d.vdi' % size)
+        create_data_disk(filename, size, fs_type)
+        return VDIImage(filename)
+
+    def check_header(self, image, size):
+        self.assertEqual(image.pre_header.rstrip('\0'), VDI_PRE_HEADER)
+        self.assertEqual(image.signature, VDI_SIGNATURE)
+        self.assertEqual(image.version, VDI_VERSION)
+        self.assertEqual(image.header_size, VDI_HEADER_SIZE)
+        self.assertEqual(image.disk_size, size * 1024 * 1024)
+        self.assertEqual(image.block_size, VDI_BLOCK_SIZE)
+        self.assertEqual(image.block_count, size)
+        self.assertEqual(image.data_offset % SECTOR_SIZE, 0)
+        self.assert_(image.data_offset >=
+                     image.blocks_offset + 4 * image.block_count)
+
+    def check_block_map(self, image):
+        allocated = [p for p in image.block_map if p != VDI_BLOCK_FREE]
+        allocated.sort()
+        self.assertEqual(allocated, range(image.blocks_allocated))
+        self.assertNotEqual(image.block_map[0], VDI_BLOCK_FREE)
+        self.assertEqual(len(image.data), image.data_offset +
+                         image.blocks_allocated * image.block_size)
+
+    def check_mbr(self, image, fs_type):
+        mbr = image.sector(0)
+        self.assertEqual(mbr[510:], '\x55\xaa')
+        (status, partition_type, start, sectors) = \
+            struct.unpack('<B3xB3xII', mbr[446:462])
+        self.assertEqual(status, 0)
+        self.assertEqual(partition_type, PARTITION_TYPES[fs_type])
+        self.assertEqual(start, PARTITION_START)
+        self.assertEqual(sectors,
+                         image.disk_size // SECTOR_SIZE - PARTITION_START)
+        self.assertEqual(mbr[462:510], '\0' * 48)
+        return start, sectors
+
+    def check_bpb(self, image, fs_type, start, sectors):
+        boot = image.sector(start)
+        self.assertEqual(boot[510:], '\x55\xaa')
+        (bytes_per_sector, sectors_per_cluster, reserved, fats, root_entries,
+         small_sectors, media, small_fat_size, hidden, large_sectors) = \
+            struct.unpack('<HBHBHHBH4xII', boot[11:36])
+        self.assertEqual(bytes_per_sector, SECTOR_SIZE)
+        self.assertEqual(fats, 2)
+        self.assertEqual(media, 0xf8)
+        self.assertEqual(hidden, start)
+        self.assertEqual(small_sectors or large_sectors, sectors)
+        if fs_type == 'fat32':
+            self.assertEqual(small_sectors, 0)
+            self.assertEqual(small_fat_size, 0)
+            self.assertEqual(root_entries, 0)
+            fat_size, root_cluster = struct.unpack('<I4xI', boot[36:48])
+            self.assertEqual(root_cluster, 2)
+            self.assertEqual(boot[82:90], 'FAT32   ')
+            # The backup boot sector.
+            self.assertEqual(image.sector(start + 6), boot)
+            fat = image.sector(start + reserved)[:12]
+            self.assertEqual(fat, struct.pack('<III', 0x0ffffff8,
+                                              0x0fffffff, 0x0fffffff))
+            min_clusters, max_clusters = 65525, 0x0ffffff5
+        else:
+            fat_size = small_fat_size
+            self.assertEqual(boot[54:62], 'FAT16   ')
+            fat = image.sector(start + reserved)[:4]
+            self.assertEqual(fat, struct.pack('<HH', 0xfff8, 0xffff))
+            min_clusters, max_clusters = 4085, 65524
+        self.assertEqual(image.sector(start + reserved + fat_size)[:len(fat)],
+                         fat)
+        root_sectors = root_entries * 32 // SECTOR_SIZE
+        data_start = reserved + 2 * fat_size + root_sectors
+        clusters = (sectors - data_start) // sectors_per_cluster
+        self.assert_(min_clusters <= clusters <= max_clusters)
+        # Both FATs must be large enough to hold all clusters.
+        entry_size = fs_type == 'fat32' and 4 or 2
+        self.assert_(fat_size * SECTOR_SIZE >= (clusters + 2) * entry_size)
+
+    def check_disk(self, size, fs_type):
+        image = self.create(size)
+        self.check_header(image, size)
+        self.check_block_map(image)
+        start, sectors = self.check_mbr(image, fs_type)
+        self.check_bpb(image, fs_type, start, sectors)
+
+    def test_8(self):
+        self.check_disk(8, 'fat16')
+
+    def test_127(self):
+        self.check_disk(127, 'fat16')
+
+    def test_128(self):
+        self.check_disk(128, 'fat32')
+
+    def test_2048(self):
+        self.check_disk(2048, 'fat32')
+
+    def test_too_small(self):
+        self.assertRaises(DataDiskError, self.create, 4)
+
+    def test_unsupported_filesystem(self):
+        self.assertRaises(DataDiskError, self.create, 64, 'ext2')
+
+if __name__ == '__main__':
+    unittest.main()
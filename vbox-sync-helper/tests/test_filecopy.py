@@ -0,0 +1,147 @@
+# vim:set et sw=4 encoding=utf-8:
+#
+# Tests for copying sparse files with itomig.filecopy
+#
+# Licensed under the EUPL, Version 1.0 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# you may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+#
+# http://ec.europa.eu/idabc/eupl
+#
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+
+"""
+Copies files with holes and runs of zeros, with all methods and with the
+buffered fallback alone, and checks the contents and the holes of the
+copies.
+"""
+
+import errno
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from itomig import filecopy
+from itomig.filecopy import copy_sparse, disk_usage, ZERO_BLOCK_SIZE
+
+MB = 1024 * 1024
+
+class FileCopyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.saved = (filecopy._clone, filecopy._data_extents,
+                      filecopy._Copier.__init__)
+
+    def tearDown(self):
+        (filecopy._clone, filecopy._data_extents,
+         filecopy._Copier.__init__) = self.saved
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def read(self, name):
+        f = open(self.path(name), 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def write_regions(self, name, size, regions):
+        """Writes the (offset, data) regions into a sparse file."""
+        f = open(self.path(name), 'wb')
+        try:
+            f.truncate(size)
+            for offset, data in regions:
+                f.seek(offset)
+                f.write(data)
+        finally:
+            f.close()
+        return self.path(name)
+
+    def holes_supported(self):
+        filename = self.write_regions('probe', 4 * MB, [])
+        return disk_usage(filename)[1] < MB
+
+    def use_buffer_only(self):
+        """Makes copy_sparse fall back to finding holes by looking at the
+        data and to copying it through a buffer."""
+        def no_clone(src_fd, dst_fd):
+            return False
+        def no_extents(fd, size):
+            raise OSError, (errno.EINVAL, os.strerror(errno.EINVAL))
+        init = filecopy._Copier.__init__
+        def init_without_methods(self, *args):
+            init(self, *args)
+            self.methods = []
+        filecopy._clone = no_clone
+        filecopy._data_extents = no_extents
+        filecopy._Copier.__init__ = init_without_methods
+
+    def regions(self):
+        # Data across a zero block boundary, zeros written out in the
+        # middle of data, a partial block at the end and a trailing hole.
+        return [(ZERO_BLOCK_SIZE - 10, 'a' * 20),
+                (MB, 'b' * ZERO_BLOCK_SIZE + '\0' * 2 * ZERO_BLOCK_SIZE +
+                     'c' * ZERO_BLOCK_SIZE),
+                (3 * MB, '\0' * MB),
+                (5 * MB - 100, 'd' * 50)]
+
+    def check_copy(self):
+        src = self.write_regions('src', 6 * MB, self.regions())
+        progress = []
+        copy_sparse(src, self.path('dst'),
+                    lambda done, total: progress.append((done, total)))
+        self.assertEqual(self.read('dst'), self.read('src'))
+        self.assert_(progress)
+        done, total = progress[-1]
+        self.assertEqual(done, total)
+        return disk_usage(self.path('dst'))
+
+    def test_copy(self):
+        size, allocated = self.check_copy()
+        self.assertEqual(size, 6 * MB)
+        if self.holes_supported():
+            self.assert_(allocated < 2 * MB)
+
+    def test_buffered_fallback(self):
+        self.use_buffer_only()
+        size, allocated = self.check_copy()
+        self.assertEqual(size, 6 * MB)
+        if self.holes_supported():
+            # The zeros written out in the source become holes as well.
+            self.assert_(allocated <= 6 * ZERO_BLOCK_SIZE)
+
+    def test_buffered_fallback_dense_file(self):
+        self.use_buffer_only()
+        data = ''.join([chr(i % 256) for i in range(3 * ZERO_BLOCK_SIZE)])
+        src = self.write_regions('src', len(data), [(0, data)])
+        copy_sparse(src, self.path('dst'))
+        self.assertEqual(self.read('dst'), data)
+
+    def test_empty_file(self):
+        self.use_buffer_only()
+        src = self.write_regions('src', 0, [])
+        copy_sparse(src, self.path('dst'))
+        self.assertEqual(self.read('dst'), '')
+
+    def test_overwrites_destination(self):
+        src = self.write_regions('src', MB, [(0, 'new')])
+        self.write_regions('dst', 2 * MB, [(0, 'old' * 1000)])
+        copy_sparse(src, self.path('dst'))
+        self.assertEqual(self.read('dst'), self.read('src'))
+
+if __name__ == '__main__':
+    unittest.main()
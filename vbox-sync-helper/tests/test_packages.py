@@ -0,0 +1,130 @@
+# vim:set et sw=4 encoding=utf-8:
+#
+# Tests for finding the packages of images with itomig.packages
+#
+# Licensed under the EUPL, Version 1.0 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# you may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+#
+# http://ec.europa.eu/idabc/eupl
+#
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+
+"""
+Runs InstalledPackages against a stand-in dpkg-query and a status file in
+a temporary directory, to check that dpkg is only queried again when the
+status file changes.
+"""
+
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from itomig.packages import InstalledPackages, image_package_candidates
+
+DPKG_QUERY = '''#!/bin/sh
+echo run >> "%(directory)s/runs"
+printf 'foo-vbox\\t1.0-1\\tinstall ok installed\\n'
+printf 'vbox-foo\\t2.0\\tinstall ok installed\\n'
+printf 'bar\\t1:0.5\\tinstall ok unpacked\\n'
+printf 'removed-vbox\\t3.0\\tdeinstall ok config-files\\n'
+printf 'broken\\n'
+'''
+
+class InstalledPackagesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.write('dpkg-query', DPKG_QUERY % {'directory': self.directory})
+        os.chmod(self.path('dpkg-query'), 0755)
+        self.saved_path = os.environ['PATH']
+        os.environ['PATH'] = self.directory + os.pathsep + self.saved_path
+        self.write('status', '')
+        self.set_mtime(1000)
+        self.packages = InstalledPackages(self.path('status'))
+
+    def tearDown(self):
+        os.environ['PATH'] = self.saved_path
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def write(self, name, data):
+        f = open(self.path(name), 'w')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+
+    def set_mtime(self, mtime):
+        os.utime(self.path('status'), (mtime, mtime))
+
+    def runs(self):
+        if not os.path.exists(self.path('runs')):
+            return 0
+        f = open(self.path('runs'))
+        try:
+            return len(f.readlines())
+        finally:
+            f.close()
+
+    def test_versions(self):
+        # Packages whose files are not on the disk and lines that cannot
+        # be parsed are left out.
+        self.assertEqual(self.packages.versions(),
+                         {'foo-vbox': '1.0-1', 'vbox-foo': '2.0',
+                          'bar': '1:0.5'})
+        self.assertEqual(self.packages.version_of('bar'), '1:0.5')
+        self.assertEqual(self.packages.version_of('removed-vbox'), None)
+
+    def test_cached_until_status_changes(self):
+        self.packages.versions()
+        self.packages.version_of('foo-vbox')
+        self.packages.find_image_package('foo')
+        self.assertEqual(self.runs(), 1)
+        self.set_mtime(2000)
+        self.packages.versions()
+        self.assertEqual(self.runs(), 2)
+        self.packages.versions()
+        self.assertEqual(self.runs(), 2)
+
+    def test_invalidate(self):
+        self.packages.versions()
+        self.packages.invalidate()
+        self.packages.versions()
+        self.assertEqual(self.runs(), 2)
+
+    def test_missing_status_file(self):
+        packages = InstalledPackages(self.path('missing'))
+        packages.versions()
+        packages.versions()
+        self.assertEqual(self.runs(), 1)
+
+    def test_no_dpkg(self):
+        os.environ['PATH'] = self.path('empty')
+        self.assertEqual(self.packages.versions(), {})
+
+    def test_find_image_package(self):
+        # foo-vbox is preferred over vbox-foo.
+        self.assertEqual(self.packages.find_image_package('foo'), 'foo-vbox')
+        self.assertEqual(self.packages.find_image_package('bar'), 'bar')
+        self.assertEqual(self.packages.find_image_package('removed'), None)
+
+    def test_candidates(self):
+        self.assertEqual(image_package_candidates('foo'),
+                         ['foo-vbox', 'vbox-foo', 'foo'])
+
+if __name__ == '__main__':
+    unittest.main()
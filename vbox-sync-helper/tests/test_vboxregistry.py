@@ -0,0 +1,285 @@
+# vim:set et sw=4 encoding=utf-8:
+#
+# Tests for VBoxRegistry against the fake VirtualBox backend
+#
+# Licensed under the EUPL, Version 1.0 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# you may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+#
+# http://ec.europa.eu/idabc/eupl
+#
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+
+"""
+Checks which calls VBoxRegistry makes to VirtualBox, as recorded by the
+fake backend: that the registry snapshot saves queries, that
+reconfigurations only apply what changed and that differential images
+are closed children first.
+"""
+
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from itomig.vbox import VBoxRegistry
+from itomig.vboxbackend import FakeVBoxBackend, VBoxInvocationError
+from itomig.vboxsettings import VBoxSettingsReader
+
+VM_UUID = '11111111-1111-1111-1111-111111111111'
+BASE_UUID = '22222222-2222-2222-2222-222222222222'
+CHILD_UUID = '33333333-3333-3333-3333-333333333333'
+GRANDCHILD_UUID = '44444444-4444-4444-4444-444444444444'
+ATTACHED_UUID = '55555555-5555-5555-5555-555555555555'
+
+GLOBAL_SETTINGS = '''<?xml version="1.0"?>
+<VirtualBox xmlns="http://www.innotek.de/VirtualBox-settings">
+  <Global>
+    <MachineRegistry>
+      <MachineEntry uuid="{%(vm)s}" src="Machines/img/img.xml"/>
+    </MachineRegistry>
+    <MediaRegistry>
+      <HardDisks>
+        <HardDisk uuid="{%(base)s}" location="%(home)s/img.vdi"
+                  format="VDI" type="Immutable">
+          <HardDisk uuid="{%(child)s}"
+                    location="Machines/img/Snapshots/{%(child)s}.vdi"
+                    format="VDI">
+            <HardDisk uuid="{%(grandchild)s}"
+                      location="Machines/img/Snapshots/{%(grandchild)s}.vdi"
+                      format="VDI"/>
+          </HardDisk>
+          <HardDisk uuid="{%(attached)s}"
+                    location="Machines/img/Snapshots/{%(attached)s}.vdi"
+                    format="VDI"/>
+        </HardDisk>
+      </HardDisks>
+    </MediaRegistry>
+  </Global>
+</VirtualBox>
+'''
+
+MACHINE_SETTINGS = '''<?xml version="1.0"?>
+<VirtualBox xmlns="http://www.innotek.de/VirtualBox-settings">
+  <Machine uuid="{%(vm)s}" name="img">
+    <HardDiskAttachments>
+      <HardDiskAttachment hardDisk="{%(attached)s}" bus="IDE" channel="0"
+                          device="0"/>
+    </HardDiskAttachments>
+  </Machine>
+</VirtualBox>
+'''
+
+class RegistryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.home = tempfile.mkdtemp()
+        self.saved_environ = os.environ.get('VBOX_USER_HOME')
+        self.registry = VBoxRegistry(self.home, 'fake')
+        self.backend = self.registry.backend
+
+    def tearDown(self):
+        if self.saved_environ is None:
+            os.environ.pop('VBOX_USER_HOME', None)
+        else:
+            os.environ['VBOX_USER_HOME'] = self.saved_environ
+        shutil.rmtree(self.home)
+
+    def calls(self, operation):
+        return [call for call in self.backend.calls if call[0] == operation]
+
+class SnapshotTest(RegistryTestCase):
+
+    def test_fake_backend(self):
+        self.assert_(isinstance(self.backend, FakeVBoxBackend))
+
+    def test_vms_listed_once(self):
+        self.assertEqual(self.registry.get_vms(), {})
+        self.registry.get_vms()
+        self.assertEqual(len(self.calls('list_vms')), 1)
+
+    def test_create_vm_updates_snapshot(self):
+        uuid = self.registry.create_vm('img')
+        self.assertEqual(self.registry.get_vms(), {uuid: 'img'})
+        self.assertEqual(self.registry.create_vm('img'), uuid)
+        self.assertEqual(len(self.calls('create_vm')), 1)
+        self.assertEqual(len(self.calls('list_vms')), 1)
+        # A new VM has nothing attached, no need to ask VirtualBox.
+        self.registry.get_vm_info(uuid)
+        self.assertEqual(self.calls('show_vm_info'), [])
+
+    def test_register_hdd_updates_snapshot(self):
+        filename = os.path.join(self.home, 'img.vdi')
+        self.assertEqual(self.registry.register_hdd(filename, 'immutable'),
+                         True)
+        self.assertEqual(self.registry.register_hdd(filename, 'immutable'),
+                         False)
+        self.assertEqual(self.registry.get_hdds(), [filename])
+        self.assertEqual(self.calls('open_hdd'),
+                         [('open_hdd', filename, 'immutable')])
+        self.assertEqual(len(self.calls('list_hdds')), 1)
+
+    def test_discard_hdd_updates_snapshot(self):
+        filename = os.path.join(self.home, 'img.vdi')
+        self.registry.register_hdd(filename)
+        self.registry.discard_hdd(filename)
+        self.assertEqual(self.registry.get_hdds(), [])
+        self.assertEqual(self.backend.hdds, {})
+        self.assertEqual(len(self.calls('list_hdds')), 1)
+
+    def test_invalidate(self):
+        self.registry.get_vms()
+        self.registry.get_hdds()
+        self.registry.invalidate()
+        self.registry.get_vms()
+        self.registry.get_hdds()
+        self.assertEqual(len(self.calls('list_vms')), 2)
+        self.assertEqual(len(self.calls('list_hdds')), 2)
+
+    def test_failure_invalidates(self):
+        self.registry.get_vms()
+        self.assertRaises(VBoxInvocationError, self.registry.modify_vm,
+                          'unknown', {'-memory': 256})
+        self.registry.get_vms()
+        self.assertEqual(len(self.calls('list_vms')), 2)
+
+    def test_modify_vm_drops_vm_info(self):
+        uuid = self.registry.create_vm('img')
+        self.registry.modify_vm(uuid, {'-memory': 256})
+        self.assertEqual(self.registry.get_vm_info(uuid)['memory'], '256')
+        self.assertEqual(len(self.calls('show_vm_info')), 1)
+
+class ReconfigurationTest(RegistryTestCase):
+
+    def setUp(self):
+        RegistryTestCase.setUp(self)
+        self.uuid = self.registry.create_vm('img')
+        self.system = os.path.join(self.home, 'img.vdi')
+        self.data = os.path.join(self.home, 'data.vdi')
+
+    def apply(self, settings, disks):
+        """Applies the settings and the disks by IDE port and returns the
+        modify_vm calls it took."""
+        del self.backend.calls[:]
+        reconfiguration = self.registry.reconfigure_vm(self.uuid)
+        reconfiguration.update(settings)
+        for ide_port, filename in disks.items():
+            reconfiguration.attach_hdd(ide_port, filename)
+        reconfiguration.apply()
+        return [parameters for (operation, identifier, parameters)
+                in self.calls('modify_vm')]
+
+    def test_new_vm(self):
+        calls = self.apply({'-memory': 256, '-acpi': 'on'},
+                           {'hda': self.system, 'hdb': self.data})
+        self.assertEqual(calls, [{'-memory': 256, '-acpi': 'on'},
+                                 {'-hda': self.system, '-hdb': self.data}])
+
+    def test_unchanged(self):
+        self.apply({'-memory': 256}, {'hda': self.system, 'hdb': self.data})
+        calls = self.apply({'-memory': 256},
+                           {'hda': self.system, 'hdb': self.data})
+        self.assertEqual(calls, [])
+
+    def test_changed_setting(self):
+        self.apply({'-memory': 256, '-acpi': 'on'}, {'hda': self.system})
+        calls = self.apply({'-memory': 512, '-acpi': 'on'},
+                           {'hda': self.system})
+        self.assertEqual(calls, [{'-memory': 512}])
+
+    def test_changed_disk(self):
+        self.apply({'-memory': 256}, {'hda': self.system, 'hdb': self.data})
+        other = os.path.join(self.home, 'other.vdi')
+        calls = self.apply({'-memory': 256},
+                           {'hda': self.system, 'hdb': other})
+        self.assertEqual(calls, [{'-hdb': 'none'}, {'-hdb': other}])
+
+class SettingsTestCase(RegistryTestCase):
+    """Sets up a VM whose system disk is attached through a differential
+    image, with two more unused ones left over from earlier runs."""
+
+    def setUp(self):
+        RegistryTestCase.setUp(self)
+        values = {'vm': VM_UUID, 'base': BASE_UUID, 'child': CHILD_UUID,
+                  'grandchild': GRANDCHILD_UUID, 'attached': ATTACHED_UUID,
+                  'home': self.home}
+        self.snapshots = os.path.join(self.home, 'Machines', 'img',
+                                      'Snapshots')
+        os.makedirs(self.snapshots)
+        self.write(os.path.join(self.home, 'VirtualBox.xml'),
+                   GLOBAL_SETTINGS % values)
+        self.write(os.path.join(self.home, 'Machines', 'img', 'img.xml'),
+                   MACHINE_SETTINGS % values)
+        for uuid in (CHILD_UUID, GRANDCHILD_UUID, ATTACHED_UUID):
+            location = self.snapshot_path(uuid)
+            self.write(location, 'x' * 4096)
+            self.backend.hdds[uuid] = (location, 'normal')
+        # The fake backend does not write settings files, read the ones
+        # written above instead.
+        self.registry.settings = VBoxSettingsReader(self.home)
+
+    def write(self, filename, data):
+        f = open(filename, 'w')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+
+    def snapshot_path(self, uuid):
+        return os.path.join(self.snapshots, '{%s}.vdi' % uuid)
+
+class ImmutableDiskTest(SettingsTestCase):
+
+    def setUp(self):
+        SettingsTestCase.setUp(self)
+        self.backend.vms[VM_UUID] = ('img', {})
+
+    def apply(self, disks):
+        reconfiguration = self.registry.reconfigure_vm(VM_UUID)
+        for ide_port, filename in disks.items():
+            reconfiguration.attach_hdd(ide_port, filename)
+        reconfiguration.apply()
+        return self.calls('modify_vm')
+
+    def test_child_attached(self):
+        base = os.path.join(self.home, 'img.vdi')
+        self.assertEqual(self.registry.get_hdd_parent(
+                             self.snapshot_path(ATTACHED_UUID)), base)
+        self.assertEqual(self.apply({'hda': base}), [])
+
+    def test_other_disk(self):
+        other = os.path.join(self.home, 'other.vdi')
+        self.assertEqual(self.apply({'hda': other}),
+                         [('modify_vm', VM_UUID, {'-hda': 'none'}),
+                          ('modify_vm', VM_UUID, {'-hda': other})])
+
+class GarbageCollectionTest(SettingsTestCase):
+
+    def test_children_closed_first(self):
+        removed, reclaimed = self.registry.garbage_collect_hdds('img')
+        self.assertEqual(removed, 2)
+        self.assert_(reclaimed > 0)
+        self.assertEqual(self.calls('close_hdd'),
+                         [('close_hdd', GRANDCHILD_UUID),
+                          ('close_hdd', CHILD_UUID)])
+        self.assertEqual(self.calls('is_hdd_in_use'), [])
+        self.assertEqual(os.listdir(self.snapshots),
+                         [os.path.basename(self.snapshot_path(ATTACHED_UUID))])
+        self.assertEqual(self.backend.hdds.keys(), [ATTACHED_UUID])
+
+    def test_no_snapshots(self):
+        self.assertEqual(self.registry.garbage_collect_hdds('other'), (0, 0))
+        self.assertEqual(self.backend.calls, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,227 @@
+# vim:set et sw=4 encoding=utf-8:
+#
+# Tests for reading the VirtualBox settings files with itomig.vboxsettings
+#
+# Licensed under the EUPL, Version 1.0 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# you may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+#
+# http://ec.europa.eu/idabc/eupl
+#
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+
+"""
+Reads fixture settings files in the layout of VirtualBox 2.x, with
+HardDiskAttachments, and of later versions, with StorageControllers.
+"""
+
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from itomig.vboxsettings import VBoxSettingsReader, VBoxSettingsError
+
+OLD_VM = '11111111-1111-1111-1111-111111111111'
+NEW_VM = '22222222-2222-2222-2222-222222222222'
+BASE = 'aaaaaaaa-aaaa-aaaa-aaaa-aaaaaaaaaaaa'
+CHILD = 'bbbbbbbb-bbbb-bbbb-bbbb-bbbbbbbbbbbb'
+GRANDCHILD = 'cccccccc-cccc-cccc-cccc-cccccccccccc'
+DATA = 'dddddddd-dddd-dddd-dddd-dddddddddddd'
+SNAPSHOT = 'eeeeeeee-eeee-eeee-eeee-eeeeeeeeeeee'
+UNUSED = 'ffffffff-ffff-ffff-ffff-ffffffffffff'
+
+GLOBAL_SETTINGS = '''<?xml version="1.0"?>
+<VirtualBox xmlns="http://www.innotek.de/VirtualBox-settings">
+  <Global>
+    <MachineRegistry>
+      <MachineEntry uuid="{%(old_vm)s}" src="Machines/old/old.xml"/>
+      <MachineEntry uuid="{%(new_vm)s}" src="%(home)s/new.xml"/>
+    </MachineRegistry>
+    <MediaRegistry>
+      <HardDisks>
+        <HardDisk uuid="{%(base)s}" location="/images/system.vdi"
+                  format="VDI" type="Immutable">
+          <HardDisk uuid="{%(child)s}"
+                    location="Machines/old/Snapshots/{%(child)s}.vdi">
+            <HardDisk uuid="{%(grandchild)s}"
+                      location="Machines/old/Snapshots/{%(grandchild)s}.vdi"/>
+          </HardDisk>
+          <HardDisk uuid="{%(snapshot)s}"
+                    location="Machines/new/Snapshots/{%(snapshot)s}.vdi"/>
+          <HardDisk uuid="{%(unused)s}"
+                    location="Machines/new/Snapshots/{%(unused)s}.vdi"/>
+        </HardDisk>
+        <HardDisk uuid="{%(data)s}" location="data.vdi" format="VDI"/>
+      </HardDisks>
+    </MediaRegistry>
+  </Global>
+</VirtualBox>
+'''
+
+# VirtualBox 2.x: the attachments are listed directly in the machine.
+OLD_MACHINE = '''<?xml version="1.0"?>
+<VirtualBox xmlns="http://www.innotek.de/VirtualBox-settings">
+  <Machine uuid="{%(old_vm)s}" name="old">
+    <HardDiskAttachments>
+      <HardDiskAttachment hardDisk="{%(grandchild)s}" bus="IDE" channel="0"
+                          device="0"/>
+      <HardDiskAttachment hardDisk="{%(data)s}" bus="IDE" channel="0"
+                          device="1"/>
+      <HardDiskAttachment hardDisk="{%(data)s}" bus="SATA" channel="0"
+                          device="0"/>
+    </HardDiskAttachments>
+  </Machine>
+</VirtualBox>
+'''
+
+# Later versions: devices attached to storage controllers in the hardware
+# section, and snapshots with attachments of their own.
+NEW_MACHINE = '''<?xml version="1.0"?>
+<VirtualBox xmlns="http://www.virtualbox.org/">
+  <Machine uuid="{%(new_vm)s}" name="new">
+    <Hardware>
+      <Memory RAMSize="256"/>
+    </Hardware>
+    <StorageControllers>
+      <StorageController name="IDE" type="PIIX4">
+        <AttachedDevice type="HardDisk" port="1" device="0">
+          <Image uuid="{%(base)s}"/>
+        </AttachedDevice>
+        <AttachedDevice type="DVD" port="1" device="1"/>
+      </StorageController>
+      <StorageController name="SATA" type="AHCI">
+        <AttachedDevice type="HardDisk" port="0" device="0">
+          <Image uuid="{%(data)s}"/>
+        </AttachedDevice>
+      </StorageController>
+    </StorageControllers>
+    <Snapshot uuid="{99999999-9999-9999-9999-999999999999}" name="s">
+      <Hardware>
+        <StorageControllers>
+          <StorageController name="IDE" type="PIIX4">
+            <AttachedDevice type="HardDisk" port="0" device="0">
+              <Image uuid="{%(snapshot)s}"/>
+            </AttachedDevice>
+          </StorageController>
+        </StorageControllers>
+      </Hardware>
+    </Snapshot>
+  </Machine>
+</VirtualBox>
+'''
+
+class SettingsReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.home = tempfile.mkdtemp()
+        self.values = {'old_vm': OLD_VM, 'new_vm': NEW_VM, 'base': BASE,
+                       'child': CHILD, 'grandchild': GRANDCHILD,
+                       'data': DATA, 'snapshot': SNAPSHOT, 'unused': UNUSED,
+                       'home': self.home}
+        os.makedirs(os.path.join(self.home, 'Machines', 'old'))
+        self.write('VirtualBox.xml', GLOBAL_SETTINGS)
+        self.write(os.path.join('Machines', 'old', 'old.xml'), OLD_MACHINE)
+        self.write('new.xml', NEW_MACHINE)
+        self.reader = VBoxSettingsReader(self.home)
+
+    def tearDown(self):
+        shutil.rmtree(self.home)
+
+    def write(self, name, template):
+        f = open(os.path.join(self.home, name), 'w')
+        try:
+            f.write(template % self.values)
+        finally:
+            f.close()
+
+    def location(self, *path):
+        return os.path.join(self.home, *path)
+
+    def snapshot_location(self, vm, uuid):
+        return self.location('Machines', vm, 'Snapshots', '{%s}.vdi' % uuid)
+
+    def test_vms(self):
+        self.assertEqual(self.reader.get_vms(), {OLD_VM: 'old',
+                                                 NEW_VM: 'new'})
+
+    def test_hdds(self):
+        hdds = self.reader.get_hdds()
+        self.assertEqual(len(hdds), 6)
+        self.assertEqual(hdds[BASE], '/images/system.vdi')
+        self.assertEqual(hdds[DATA], self.location('data.vdi'))
+        self.assertEqual(hdds[GRANDCHILD],
+                         self.snapshot_location('old', GRANDCHILD))
+
+    def test_parents(self):
+        self.assertEqual(self.reader.get_parent(BASE), None)
+        self.assertEqual(self.reader.get_parent(DATA), None)
+        self.assertEqual(self.reader.get_parent(CHILD), BASE)
+        self.assertEqual(self.reader.get_parent(GRANDCHILD), CHILD)
+        self.assertEqual(self.reader.get_parent(SNAPSHOT), BASE)
+
+    def test_depth(self):
+        self.assertEqual(self.reader.get_depth(BASE), 0)
+        self.assertEqual(self.reader.get_depth(CHILD), 1)
+        self.assertEqual(self.reader.get_depth(GRANDCHILD), 2)
+        self.assertEqual(self.reader.get_depth(UNUSED), 1)
+
+    def test_hard_disk_attachments(self):
+        # The SATA attachment is not on an IDE port.
+        self.assertEqual(self.reader.get_attached_hdds('old'),
+                         {'hda': self.snapshot_location('old', GRANDCHILD),
+                          'hdb': self.location('data.vdi')})
+        self.assertEqual(self.reader.get_attached_hdds(OLD_VM),
+                         self.reader.get_attached_hdds('old'))
+
+    def test_storage_controllers(self):
+        # Neither the DVD drive, the SATA controller nor the snapshot
+        # count.
+        self.assertEqual(self.reader.get_attached_hdds('new'),
+                         {'hdc': '/images/system.vdi'})
+
+    def test_unknown_vm(self):
+        self.assertRaises(VBoxSettingsError, self.reader.get_attached_hdds,
+                          'unknown')
+
+    def test_in_use(self):
+        # Everything attached, in snapshots as well, and their parents.
+        self.assertEqual(self.reader.get_hdds_in_use(),
+                         set([BASE, CHILD, GRANDCHILD, DATA, SNAPSHOT]))
+        self.assertEqual(self.reader.is_hdd_in_use(SNAPSHOT), True)
+        self.assertEqual(self.reader.is_hdd_in_use(CHILD), False)
+        self.assertEqual(self.reader.is_hdd_in_use(UNUSED), False)
+
+    def test_invalidate(self):
+        self.reader.get_vms()
+        os.unlink(os.path.join(self.home, 'new.xml'))
+        self.assertEqual(len(self.reader.get_vms()), 2)
+        self.reader.invalidate()
+        self.assertRaises(VBoxSettingsError, self.reader.get_vms)
+
+    def test_malformed(self):
+        f = open(os.path.join(self.home, 'VirtualBox.xml'), 'w')
+        try:
+            f.write('<VirtualBox>')
+        finally:
+            f.close()
+        self.assertRaises(VBoxSettingsError, self.reader.get_vms)
+
+    def test_no_home(self):
+        self.assertRaises(VBoxSettingsError,
+                          VBoxSettingsReader(None).get_vms)
+        reader = VBoxSettingsReader(self.location('missing'))
+        self.assertRaises(VBoxSettingsError, reader.get_hdds)
+
+if __name__ == '__main__':
+    unittest.main()